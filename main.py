@@ -1,9 +1,11 @@
 import logging
+import tempfile
+
 from matplotlib import pyplot as plt
 import numpy as np
 
+from prototype_jpeg import compress_ladder, extract
 from prototype_jpeg.utils import psnr
-from tests.test_prototype_jpeg import compress_and_extract
 
 logging.basicConfig(level=logging.INFO)
 
@@ -33,17 +35,25 @@ def main():
             (512, 512) if ('grey_level' in fn) else (512, 512, 3)
         )
         axarr[i][0].imshow(original, cmap='gray', vmin=0, vmax=255)
-        for j, q in enumerate(qualities):
-            logging.getLogger(__name__).info('------- QF: %s -------' % q)
-            extracted = compress_and_extract({
-                'fn': fn,
-                'size': (512, 512),
-                'grey_level': ('grey_level' in fn),
-                'quality': q,
-                'subsampling_mode': 1
-            }).reshape(
-                (512, 512) if ('grey_level' in fn) else (512, 512, 3)
+        with open(fn, 'rb') as raw_file:
+            ladder = compress_ladder(
+                raw_file,
+                size=(512, 512),
+                qualities=qualities,
+                grey_level=('grey_level' in fn),
+                subsampling_mode=1
             )
+        for j, (q, compressed) in enumerate(zip(qualities, ladder)):
+            logging.getLogger(__name__).info('------- QF: %s -------' % q)
+            with tempfile.TemporaryFile() as compressed_file:
+                compressed['data'].tofile(compressed_file)
+                compressed_file.seek(0)
+                extracted = extract(
+                    compressed_file,
+                    header=compressed['header']
+                ).reshape(
+                    (512, 512) if ('grey_level' in fn) else (512, 512, 3)
+                )
             logging.getLogger(__name__).info(
                 '---------- PSNR: %.8f ----' % psnr(original, extracted)
             )
@@ -1,34 +1,45 @@
+import concurrent.futures
+import itertools
 import logging
 import math
+from multiprocessing.shared_memory import SharedMemory
 import os
 import time
 
 from bitarray import bitarray, bits2bytes
 import numpy as np
 
-from .codec import Encoder, Decoder, DC, AC, LUMINANCE, CHROMINANCE
-from .utils import (rgb2ycbcr, ycbcr2rgb, downsample, upsample, block_slice,
-                    block_combine, dct2d, idct2d, quantize, Y, CB, CR)
+from .codec import (Encoder, Decoder, count_bits, block_bit_lengths, DC, AC,
+                    LUMINANCE, CHROMINANCE)
+from .optimize import (symbol_histogram, optimize_quantization,
+                       optimize_huffman_table, huffman_codeword)
+from .utils import (rgb2ycbcr_downsample, ycbcr2rgb_upsample, pad_block_slice,
+                    crop_block_combine, flat_blocks, dct2d, idct2d, quantize,
+                    is_grey, estimate_psnr as estimate_dct_psnr,
+                    RGB2YCBCR_COEFFICIENTS, Y, CB, CR)
 
 __version__ = '0.1.0'
 
 #############################################################
 # Compress Algorithm:                                       #
-#       Color Space Conversion                              #
+#       Color Space Conversion and                          #
 #       Subsampling (Chrominance)                           #
 #       Level Offset (Luminance)                            #
 #       For each color layer:                               #
 #           Pad layer to 8n * 8n                            #
 #           8*8 Slicing                                     #
 #           For each slicing:                               #
-#               DCT                                         #
+#               DCT (DC only for flat slicing)              #
 #               Quantization (Luminance and Chrominance)    #
 #               Entropy Coder (Luminance and Chrominance)   #
 #       Write Header                                        #
 #############################################################
 
 
-def compress(file_object, size, quality=50, grey_level=False, subsampling_mode=1):  # pylint: disable=too-many-locals
+def compress(file_object, size, quality=50, grey_level=False, subsampling_mode=1,  # pylint: disable=too-many-arguments, too-many-locals
+             fixed_point=False, box_filter=False, compact=False,
+             target_bytes=None, target_psnr=None, estimate_psnr=False,
+             rdo=False, detect_grey=False, grey_tolerance=0, mcu_rows=None):
     start_time = time.perf_counter()
     logging.getLogger(__name__).info(
         'Original file size: %d Bytes', os.fstat(file_object.fileno()).st_size
@@ -36,54 +47,441 @@ def compress(file_object, size, quality=50, grey_level=False, subsampling_mode=1
 
     if quality <= 0 or quality > 95:
         raise ValueError('Quality should within (0, 95].')
+    if target_bytes is not None and target_psnr is not None:
+        raise ValueError('Only one of target size or target PSNR can be set.')
 
     img_arr = np.fromfile(file_object, dtype=np.uint8).reshape(
         size if grey_level else (*size, 3)
     )
 
-    if grey_level:
-        data = {Y: img_arr.astype(float)}
+    # Neutral RGB images are compressed as grey level ones and expanded to RGB
+    # by extract.
+    expand_to_rgb = (detect_grey and not grey_level
+                     and is_grey(img_arr, grey_tolerance))
+    if expand_to_rgb:
+        logging.getLogger(__name__).info('Detected grey level image.')
+        img_arr = np.rint(img_arr @ RGB2YCBCR_COEFFICIENTS[Y]).astype(np.uint8)
+        grey_level = True
+
+    coefficients = _transform(
+        img_arr,
+        grey_level,
+        subsampling_mode,
+        fixed_point=fixed_point,
+        box_filter=box_filter,
+        compact=compact,
+        mcu_rows=mcu_rows
+    )
 
-    else:  # RGB
-        # Color Space Conversion (w/o Level Offset)
-        data = rgb2ycbcr(*(img_arr[:, :, idx] for idx in range(3)))
+    if target_bytes is not None:
+        # Rate Control: Find the highest quality fitting in the target size
+        # by counting bits of the requantized coefficients.
+        quality = _bisect_quality(
+            lambda q: bits2bytes(_count_bits(
+                _quantize(coefficients, q, compact=compact),
+                grey_level
+            )) <= target_bytes
+        )
+        if not quality:
+            raise ValueError(f'Cannot compress into {target_bytes} Bytes.')
+        logging.getLogger(__name__).info(
+            'Quality for target size %d Bytes: %d', target_bytes, quality
+        )
 
-        # Subsampling
-        data[CB] = downsample(data[CB], subsampling_mode)
-        data[CR] = downsample(data[CR], subsampling_mode)
+    if target_psnr is not None:
+        # Find the lowest quality meeting the target PSNR with the PSNR
+        # estimated from the quantization error of coefficients.
+        quality = _bisect_quality(
+            lambda q: estimate_dct_psnr(
+                coefficients,
+                _quantize(coefficients, q, compact=compact),
+                q
+            ) < target_psnr
+        ) + 1
+        if quality > 95:
+            raise ValueError(f'Cannot reach the target PSNR {target_psnr}.')
+        logging.getLogger(__name__).info(
+            'Quality for target PSNR %.4f: %d', target_psnr, quality
+        )
 
-    # Level Offset
-    data[Y] = data[Y] - 128
+    if rdo:
+        # Rate-distortion optimized quantization only removes bits, so the
+        # quality found by the rate control above still fits.
+        rdo_start_time = time.process_time()
+        quantized = _quantize(coefficients, quality, compact=compact, rdo=True)
+        rdo_time = time.process_time() - rdo_start_time
+        logging.getLogger(__name__).info(
+            'RDO quantization CPU time: %.4f seconds', rdo_time
+        )
+    else:
+        quantized = _quantize(coefficients, quality, compact=compact)
+    compressed = _encode(
+        quantized,
+        {
+            'size': size,
+            'grey_level': grey_level,
+            'quality': quality,
+            'subsampling_mode': subsampling_mode,
+            'expand_to_rgb': expand_to_rgb
+        }
+    )
 
-    for key, layer in data.items():
-        nrows, ncols = layer.shape
+    if estimate_psnr or target_psnr is not None:
+        compressed['psnr'] = estimate_dct_psnr(coefficients, quantized, quality)
+        logging.getLogger(__name__).info(
+            'Estimated PSNR: %.4f', compressed['psnr']
+        )
 
-        # Pad Layers to 8N * 8N
-        data[key] = np.pad(
-            layer,
-            (
-                (0, (nrows // 8 + 1) * 8 - nrows if nrows % 8 else 0),
-                (0, (ncols // 8 + 1) * 8 - ncols if ncols % 8 else 0)
+    if rdo:
+        compressed['rdo_time'] = rdo_time
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def compress_ladder(file_object, size, qualities=(90, 80, 50, 20, 10, 5),  # pylint: disable=too-many-arguments, too-many-locals
+                    grey_level=False, subsampling_mode=1, fixed_point=False,
+                    box_filter=False, compact=False, max_workers=1):
+    start_time = time.perf_counter()
+    logging.getLogger(__name__).info(
+        'Original file size: %d Bytes', os.fstat(file_object.fileno()).st_size
+    )
+
+    for quality in qualities:
+        if quality <= 0 or quality > 95:
+            raise ValueError('Quality should within (0, 95].')
+
+    img_arr = np.fromfile(file_object, dtype=np.uint8).reshape(
+        size if grey_level else (*size, 3)
+    )
+
+    # The color space conversion, subsampling, padding and DCT are shared by
+    # all qualities.
+    coefficients = _transform(
+        img_arr,
+        grey_level,
+        subsampling_mode,
+        fixed_point=fixed_point,
+        box_filter=box_filter,
+        compact=compact
+    )
+    specs = [{
+        'size': size,
+        'grey_level': grey_level,
+        'quality': quality,
+        'subsampling_mode': subsampling_mode
+    } for quality in qualities]
+
+    if max_workers == 1:
+        ladder = [_quantize_and_encode(coefficients, spec, compact)
+                  for spec in specs]
+    else:
+        ladder = _quantize_and_encode_shared(coefficients, specs, compact,
+                                             max_workers)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return ladder
+
+
+def analyze(file_object, size, quality=50, grey_level=False, subsampling_mode=1,  # pylint: disable=too-many-arguments
+            fixed_point=False, box_filter=False, compact=False):
+    start_time = time.perf_counter()
+
+    if quality <= 0 or quality > 95:
+        raise ValueError('Quality should within (0, 95].')
+
+    img_arr = np.fromfile(file_object, dtype=np.uint8).reshape(
+        size if grey_level else (*size, 3)
+    )
+
+    analysis = _analyze(
+        _quantize(
+            _transform(
+                img_arr,
+                grey_level,
+                subsampling_mode,
+                fixed_point=fixed_point,
+                box_filter=box_filter,
+                compact=compact
             ),
-            mode='constant'
-        )
+            quality,
+            compact=compact
+        ),
+        grey_level
+    )
+
+    logging.getLogger(__name__).info(
+        'Analyzed compressed file size: %d Bytes', analysis['size']
+    )
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return analysis
+
+
+def _analyze(data, grey_level):
+    """Count the exact bit lengths and symbols of entropy encoded quantized
+    blocks of each layer without encoding them.
+
+    Returns:
+        dict -- The analysis in the format:
+            ```
+            ret = {
+                'bits': 1234,  # Total bit length.
+                'size': 155,  # Total size in bytes.
+                # The same as `data_slice_lengths` in header.
+                'data_slice_lengths': (12, 34, 56, 78),
+                # Bit lengths of each layer.
+                'layers': {Y: {DC: 12, AC: 34}, CB: {...}, CR: {...}},
+                # Symbol histograms of each segment. Grey level images only
+                # have {DC: ..., AC: ...}.
+                'histograms': {
+                    LUMINANCE: {DC: Counter(...), AC: Counter(...)},
+                    CHROMINANCE: {DC: Counter(...), AC: Counter(...)}
+                }
+            }
+            ```
+    """
+
+    segments = {LUMINANCE: data[Y]}
+    if not grey_level:
+        segments[CHROMINANCE] = np.vstack((data[CB], data[CR]))
+
+    lengths = {layer_type: block_bit_lengths(blocks, layer_type)
+               for layer_type, blocks in segments.items()}
+    data_slice_lengths = tuple(int(lengths[layer_type][dc_ac].sum())
+                               for layer_type in segments
+                               for dc_ac in (DC, AC))
+
+    layers = {Y: {k: int(v.sum()) for k, v in lengths[LUMINANCE].items()}}
+    if not grey_level:
+        # The DC of the first Cr block is differential to the last Cb one.
+        layers[CB] = {k: int(v[:len(data[CB])].sum())
+                      for k, v in lengths[CHROMINANCE].items()}
+        layers[CR] = {k: int(v[len(data[CB]):].sum())
+                      for k, v in lengths[CHROMINANCE].items()}
+
+    histograms = {layer_type: symbol_histogram(blocks)
+                  for layer_type, blocks in segments.items()}
+
+    return {
+        'bits': sum(data_slice_lengths),
+        'size': bits2bytes(sum(data_slice_lengths)),
+        'data_slice_lengths': data_slice_lengths,
+        'layers': layers,
+        'histograms': histograms[LUMINANCE] if grey_level else histograms
+    }
 
-        # Block Slicing
-        data[key] = block_slice(data[key], 8, 8)
 
-        for idx, block in enumerate(data[key]):
-            # 2D DCT
-            data[key][idx] = dct2d(block)
+def _quantize_and_encode(coefficients, spec, compact=False):
+    return _encode(_quantize(coefficients, spec['quality'], compact=compact),
+                   spec)
+
+
+def _quantize_and_encode_shared(coefficients, specs, compact=False,
+                                max_workers=None):
+    """Quantize and encode the coefficients with each spec in a process pool.
+    The coefficients are copied into a shared memory segment once, so only
+    its name and the (key, shape, dtype, offset) of each layer are pickled.
+    """
+    layouts = []
+    offset = 0
+    for key, layer in coefficients.items():
+        layouts.append((key, layer.shape, layer.dtype.str, offset))
+        offset += layer.nbytes
+    segment = SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for key, shape, dtype, offset in layouts:
+            np.ndarray(shape, dtype=dtype, buffer=segment.buf,
+                       offset=offset)[...] = coefficients[key]
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            ladder = list(executor.map(
+                _quantize_and_encode_attached,
+                itertools.repeat(segment.name),
+                itertools.repeat(layouts),
+                specs,
+                itertools.repeat(compact)
+            ))
+    finally:
+        segment.close()
+        segment.unlink()
+    return ladder
+
+
+def _quantize_and_encode_attached(name, layouts, spec, compact=False):
+    """Quantize and encode the coefficients laid out in a shared memory
+    segment by `_quantize_and_encode_shared`."""
+    segment = SharedMemory(name=name)
+    try:
+        coefficients = {
+            key: np.ndarray(shape, dtype=dtype, buffer=segment.buf,
+                            offset=offset)
+            for key, shape, dtype, offset in layouts
+        }
+        compressed = _quantize_and_encode(coefficients, spec, compact)
+        del coefficients
+    finally:
+        segment.close()
+    return compressed
 
-            # Quantization
-            data[key][idx] = quantize(data[key][idx], key, quality=quality)
+
+def _transform(img_arr, grey_level, subsampling_mode, fixed_point=False,  # pylint: disable=too-many-arguments
+               box_filter=False, compact=False, mcu_rows=None):
+    """Run color space conversion, subsampling, level offset, padding, slicing
+    and 2D DCT on an image. If `mcu_rows` is set, run them on strips of
+    `mcu_rows` MCU rows one by one, so that the layers of a strip stay in
+    cache.
+
+    Returns:
+        dict -- A dictionary containing unquantized DCT blocks of each layer.
+    """
+
+    if mcu_rows is not None:
+        return _transform_strips(img_arr, grey_level, subsampling_mode,
+                                 mcu_rows, fixed_point=fixed_point,
+                                 box_filter=box_filter, compact=compact)
+
+    # Compact mode keeps spatial planes in float32.
+    float_type = np.float32 if compact else float
+
+    if grey_level:
+        data = {Y: img_arr.astype(float_type)}
+
+    else:  # RGB
+        # Color Space Conversion (w/o Level Offset) and Subsampling
+        data = rgb2ycbcr_downsample(
+            img_arr,
+            subsampling_mode,
+            box_filter=box_filter,
+            fixed_point=fixed_point,
+            dtype=float_type
+        )
+
+    # Level Offset
+    data[Y] -= 128
+
+    for key, layer in data.items():
+        # Pad Layers to 8N * 8N and Block Slicing
+        data[key] = pad_block_slice(layer, 8, 8, dtype=float_type)
+
+        # Flat blocks have no AC and their DC of orthonormal 2D DCT is
+        # 8 * value, so the DCT can be skipped.
+        flat = flat_blocks(data[key])
+        flat_dc = data[key][flat, 0, 0] * 8
+        data[key][flat] = 0
+        data[key][flat, 0, 0] = flat_dc
+
+        # 2D DCT on the stack of the other blocks at once
+        data[key][~flat] = dct2d(data[key][~flat])
+
+    return data
+
+
+def _transform_strips(img_arr, grey_level, subsampling_mode, mcu_rows,
+                      **kwargs):
+    """Run `_transform` on strips of `mcu_rows` MCU rows one by one and
+    combine their blocks."""
+    strips = _strips({'size': img_arr.shape[:2], 'grey_level': grey_level,
+                      'subsampling_mode': subsampling_mode}, mcu_rows)
+    data = {}
+    for rows, strip in strips:
+        transformed = _transform(img_arr[rows], grey_level, subsampling_mode,
+                                 **kwargs)
+        for key, layer in transformed.items():
+            if key not in data:
+                data[key] = np.empty((strips[-1][1][key][0].stop, 8, 8),
+                                     dtype=layer.dtype)
+            data[key][strip[key][0]] = layer
+    return data
+
+
+def _quantize(coefficients, quality, compact=False, rdo=False):
+    """Quantize and round the DCT blocks of each layer. Compact mode keeps
+    coefficients in int16. RDO mode rounds with rate-distortion optimization
+    instead of uniform rounding."""
+    int_type = np.int16 if compact else int
+    ret = {}
+    for key, layer in coefficients.items():
+        # Quantization
+        ret[key] = quantize(layer, key, quality=quality)
 
         # Rounding
-        data[key] = np.rint(data[key]).astype(int)
+        if rdo:
+            ret[key] = optimize_quantization(
+                ret[key],
+                LUMINANCE if key == Y else CHROMINANCE,
+                dtype=int_type
+            )
+        else:
+            ret[key] = np.rint(ret[key], out=ret[key]).astype(int_type)
+    return ret
 
+
+def _count_bits(data, grey_level):
+    """Count the bit length of entropy encoded quantized blocks of each layer
+    without encoding them."""
     if grey_level:
+        return sum(count_bits(data[Y], LUMINANCE).values())
+    return (sum(count_bits(data[Y], LUMINANCE).values())
+            + sum(count_bits(np.vstack((data[CB], data[CR])),
+                             CHROMINANCE).values()))
+
+
+def _bisect_quality(predicate):
+    """Binary search the highest integer quality within [1, 95] satisfying
+    `predicate`, which should hold for all the qualities lower than the result.
+    Return 0 if no quality satisfies it."""
+    low, high = 0, 95
+    while low < high:
+        mid = (low + high + 1) // 2
+        if predicate(mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _encode(data, spec, optimize_huffman=False):
+    """Entropy encode quantized blocks of each layer and write header.
+
+    Arguments:
+        data {dict} -- A dictionary containing quantized blocks of each layer.
+        spec {dict} -- The image spec (`size`, `grey_level`, `quality` and
+            `subsampling_mode`) of header.
+
+    Keyword Arguments:
+        optimize_huffman {bool} -- Encode with Huffman tables optimized for
+            the data instead of the baseline ones, and write them into header.
+            (default: {False})
+
+    Returns:
+        dict -- The compressed bits and its header.
+    """
+
+    segments = {LUMINANCE: data[Y]}
+    if not spec['grey_level']:
+        segments[CHROMINANCE] = np.vstack((data[CB], data[CR]))
+
+    tables = {}
+    if optimize_huffman:
+        for layer_type, blocks in segments.items():
+            histograms = symbol_histogram(blocks)
+            tables[layer_type] = {
+                dc_ac: optimize_huffman_table(histograms[dc_ac])
+                for dc_ac in (DC, AC)
+            }
+    codewords = {layer_type: {dc_ac: huffman_codeword(*table[dc_ac])
+                              for dc_ac in (DC, AC)}
+                 for layer_type, table in tables.items()}
+
+    if spec['grey_level']:
         # Entropy Encoder
-        encoded = Encoder(data[Y], LUMINANCE).encode()
+        encoded = Encoder(segments[LUMINANCE], LUMINANCE,
+                          codeword=codewords.get(LUMINANCE)).encode()
 
         # Combine grey level data as binary in the order:
         #   DC, AC
@@ -92,11 +490,9 @@ def compress(file_object, size, quality=50, grey_level=False, subsampling_mode=1
     else:  # RGB
         # Entropy Encoder
         encoded = {
-            LUMINANCE: Encoder(data[Y], LUMINANCE).encode(),
-            CHROMINANCE: Encoder(
-                np.vstack((data[CB], data[CR])),
-                CHROMINANCE
-            ).encode()
+            layer_type: Encoder(blocks, layer_type,
+                                codeword=codewords.get(layer_type)).encode()
+            for layer_type, blocks in segments.items()
         }
 
         # Combine RGB data as binary in the order:
@@ -106,56 +502,275 @@ def compress(file_object, size, quality=50, grey_level=False, subsampling_mode=1
 
     bits = bitarray(''.join(order))
 
-    logging.getLogger(__name__).info(
-        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
-    )
     return {
         'data': bits,
         'header': {
-            'size': size,
-            'grey_level': grey_level,
-            'quality': quality,
-            'subsampling_mode': subsampling_mode,
+            'size': spec['size'],
+            'grey_level': spec['grey_level'],
+            'quality': spec['quality'],
+            'subsampling_mode': spec['subsampling_mode'],
             # Remaining bits length is the fake filled bits for 8 bits as a
             # byte.
             'remaining_bits_length': bits2bytes(len(bits)) * 8 - len(bits),
-            'data_slice_lengths': tuple(len(d) for d in order)
+            'data_slice_lengths': tuple(len(d) for d in order),
+            # Only transposed images have this flag.
+            **({'transposed': True} if spec.get('transposed') else {}),
+            # Only grey level images detected from RGB have this flag.
+            **({'expand_to_rgb': True} if spec.get('expand_to_rgb') else {}),
+            # Optimized Huffman tables as (counts, symbols) in the same order
+            # as data slices.
+            **({'huffman_tables': tuple(table[dc_ac]
+                                        for table in tables.values()
+                                        for dc_ac in (DC, AC))}
+               if tables else {})
         }
     }
 
 
-def extract(file_object, header):  # pylint: disable=too-many-branches, too-many-locals
-    def school_round(val):
-        if float(val) % 1 >= 0.5:
-            return math.ceil(val)
-        return round(val)
-
+def extract(file_object, header, fixed_point=False, compact=False,  # pylint: disable=too-many-arguments
+            luma_only=False, planar=False, mcu_rows=None):
     start_time = time.perf_counter()
+    _log_compressed_size(file_object)
+
+    # Calculate the size of each layer after subsampling.
+    sizes = _layer_sizes(header)
+
+    # Huffman Decoding (compact mode keeps coefficients in int16 and spatial
+    # planes in float32)
+    data = _decode(file_object, header, dtype=np.int16 if compact else int,
+                   luma_only=luma_only)
+
+    if mcu_rows is None:
+        raw = _reconstruct(data, sizes, header, fixed_point=fixed_point,
+                           compact=compact, luma_only=luma_only, planar=planar)
+    else:
+        # Reconstruct strips of MCU rows one by one, so that the layers of a
+        # strip stay in cache from inverse quantization to color conversion.
+        strips = [
+            _reconstruct(
+                {key: layer[strip[key][0]] for key, layer in data.items()},
+                {key: strip[key][1] for key in data},
+                header,
+                fixed_point=fixed_point,
+                compact=compact,
+                luma_only=luma_only,
+                planar=planar
+            )
+            for _, strip in _strips(header, mcu_rows)
+        ]
+        if planar:
+            raw = {key: np.vstack([strip[key] for strip in strips])
+                   for key in strips[0]}
+        else:
+            raw = np.concatenate(strips)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return raw
+
+
+def _log_compressed_size(file_object):
+    """Log the size of a compressed file."""
     logging.getLogger(__name__).info(
         'Compressed file size: %d Bytes',
         os.fstat(file_object.fileno()).st_size
     )
 
-    bits = bitarray()
-    bits.fromfile(file_object)
-    bits = bits.to01()
 
-    # Read Header
-    size = header['size']
+def _reconstruct(data, sizes, header, fixed_point=False, compact=False,  # pylint: disable=too-many-arguments
+                 luma_only=False, planar=False):
+    """Run inverse quantization, 2D IDCT, combination, inverse level offset,
+    upsampling and color space conversion on Huffman decoded blocks of each
+    layer.
+
+    Returns:
+        np.array or dict -- The raw data, or the planes in planar mode.
+    """
+
     grey_level = header['grey_level']
     quality = header['quality']
     subsampling_mode = header['subsampling_mode']
-    remaining_bits_length = header['remaining_bits_length']
-    dsls = header['data_slice_lengths']  # data_slice_lengths
+    transposed = header.get('transposed', False)
+
+    for key, layer in data.items():
+        if compact:
+            layer = layer.astype(np.float32)
+        # Inverse Quantization
+        layer[...] = quantize(
+            layer,
+            key,
+            quality=quality,
+            inverse=True,
+            transposed=transposed
+        )
 
-    # Calculate the size after subsampling.
-    if subsampling_mode == 4:
+        # 2D IDCT on the stack of blocks at once
+        layer[...] = idct2d(layer)
+
+        # Combine the blocks into original image and clip the padded part
+        data[key] = crop_block_combine(layer, *sizes[key])
+
+    # Inverse Level Offset
+    data[Y] += 128
+
+    if planar:
+        # Rounding and Clipping each layer in its own resolution without
+        # upsampling and color space conversion.
+        raw = _uint8_planes(data)
+    elif grey_level or luma_only:
+        # Rounding and Clipping
+        raw = np.rint(np.clip(data[Y], 0, 255)).astype(np.uint8).ravel()
+        if header.get('expand_to_rgb') and not luma_only:
+            # Expand to RGB of the same values.
+            raw = np.repeat(raw, 3)
+    else:
+        if fixed_point:
+            # Rounding and Clipping
+            data = _uint8_planes(data)
+
+        # Upsampling, Color Space Conversion, Rounding, Clipping and
+        # Combining layers into signle raw data.
+        raw = ycbcr2rgb_upsample(
+            data[Y],
+            data[CB],
+            data[CR],
+            subsampling_mode,
+            fixed_point=fixed_point
+        ).ravel()
+    return raw
+
+
+def _uint8_planes(data):
+    """Round and clip the Y, Cb and Cr layers into uint8 planes, where Cb and
+    Cr are offset by 128."""
+    return {
+        k: np.clip(np.rint(v) + (0 if k == Y else 128), 0, 255)
+        .astype(np.uint8)
+        for k, v in data.items()
+    }
+
+
+def _mcu_size(header):
+    """Return the size of a minimum coded unit, which covers an 8x8 block of
+    every layer."""
+    if header['grey_level'] or header['subsampling_mode'] == 4:
+        return (8, 8)
+    if header['subsampling_mode'] == 2:
+        return (8, 16)
+    return (16, 16)
+
+
+def _block_grid(layer, size):
+    """Reshape the blocks of a layer into its 2D grid of blocks."""
+    return layer.reshape(-(-size[0] // 8), -(-size[1] // 8), 8, 8)
+
+
+def _strips(header, mcu_rows):
+    """Split an image into horizontal strips of `mcu_rows` MCU rows.
+
+    Returns:
+        list -- The pixel rows of each strip, and the slice of blocks and the
+            size of each layer in the strip, in the format:
+            ```
+            ret = [
+                (slice(0, 16), {Y: (slice(0, 128), (16, 512)), CB: ...}),
+                ...
+            ]
+            ```
+    """
+    sizes = _layer_sizes(header)
+    mcu_height = _mcu_size(header)[0]
+    strip_height = mcu_rows * mcu_height
+    # Chrominance of vertically subsampled images has half rows.
+    factors = {key: 1 if key == Y else mcu_height // 8 for key in sizes}
+    return [
+        (slice(top, top + strip_height), {
+            key: _strip_layer(top // factors[key],
+                              strip_height // factors[key], size)
+            for key, size in sizes.items()
+        })
+        for top in range(0, sizes[Y][0], strip_height)
+    ]
+
+
+def _strip_layer(top, height, size):
+    """Return the slice of blocks and the size of the strip of `height` rows
+    from row `top` of a layer."""
+    nrows, ncols = size
+    rows = min(height, nrows - top)
+    ncols_blocks = -(-ncols // 8)
+    start = top // 8 * ncols_blocks
+    return slice(start, start + -(-rows // 8) * ncols_blocks), (rows, ncols)
+
+
+def _layer_sizes(header):
+    """Calculate the size of each layer after subsampling."""
+    def school_round(val):
+        if float(val) % 1 >= 0.5:
+            return math.ceil(val)
+        return round(val)
+
+    size = tuple(header['size'])
+    if header['grey_level']:
+        return {Y: size}
+
+    if header['subsampling_mode'] == 4:
         subsampled_size = size
     else:
         subsampled_size = (
-            size[0] if subsampling_mode == 2 else school_round(size[0] / 2),
+            size[0] if header['subsampling_mode'] == 2
+            else school_round(size[0] / 2),
             school_round(size[1] / 2)
         )
+    return {Y: size, CB: subsampled_size, CR: subsampled_size}
+
+
+def _decode(file_object, header, dtype=int, luma_only=False):
+    """Read the compressed bits and Huffman decode the quantized blocks of each
+    layer. Luma only mode reads and decodes the luminance of RGB images only.
+
+    Returns:
+        dict -- A dictionary containing quantized blocks of each layer.
+    """
+
+    bits = bitarray()
+    if luma_only and not header['grey_level']:
+        # The luminance slices come first, so read their bytes and decode them
+        # as a grey level image.
+        luma_length = sum(header['data_slice_lengths'][:2])
+        bits.frombytes(file_object.read(bits2bytes(luma_length)))
+        header = {
+            **header,
+            'grey_level': True,
+            'remaining_bits_length': len(bits) - luma_length,
+            'data_slice_lengths': header['data_slice_lengths'][:2],
+            **({'huffman_tables': header['huffman_tables'][:2]}
+               if 'huffman_tables' in header else {})
+        }
+    else:
+        bits.fromfile(file_object)
+    return _decode_bits(bits, header, dtype=dtype)
+
+
+def _decode_bits(bits, header, dtype=int):
+    """Huffman decode the quantized blocks of each layer from the compressed
+    bits."""
+
+    bits = bits.to01()
+
+    # Optimized Huffman tables in the order of data slices.
+    codewords = {}
+    if 'huffman_tables' in header:
+        tables = iter(header['huffman_tables'])
+        for layer_type in ((LUMINANCE,) if header['grey_level']
+                           else (LUMINANCE, CHROMINANCE)):
+            codewords[layer_type] = {dc_ac: huffman_codeword(*next(tables))
+                                     for dc_ac in (DC, AC)}
+
+    grey_level = header['grey_level']
+    remaining_bits_length = header['remaining_bits_length']
+    dsls = header['data_slice_lengths']  # data_slice_lengths
 
     # Preprocessing Byte Sequence:
     #   1. Remove Remaining (Fake Filled) Bits.
@@ -187,64 +802,19 @@ def extract(file_object, header):  # pylint: disable=too-many-branches, too-many
 
     # Huffman Decoding
     if grey_level:
-        data = {Y: Decoder(sliced, LUMINANCE).decode()}
+        data = {Y: Decoder(sliced, LUMINANCE, dtype=dtype,
+                           codeword=codewords.get(LUMINANCE)).decode()}
     else:
         cb, cr = np.split(Decoder(  # pylint: disable=invalid-name, unbalanced-tuple-unpacking
             sliced[CHROMINANCE],
-            CHROMINANCE
+            CHROMINANCE,
+            dtype=dtype,
+            codeword=codewords.get(CHROMINANCE)
         ).decode(), 2)
         data = {
-            Y: Decoder(sliced[LUMINANCE], LUMINANCE).decode(),
+            Y: Decoder(sliced[LUMINANCE], LUMINANCE, dtype=dtype,
+                       codeword=codewords.get(LUMINANCE)).decode(),
             CB: cb,
             CR: cr
         }
-
-    for key, layer in data.items():
-        for idx, block in enumerate(layer):
-            # Inverse Quantization
-            layer[idx] = quantize(
-                block,
-                key,
-                quality=quality,
-                inverse=True
-            )
-
-            # 2D IDCT.
-            layer[idx] = idct2d(layer[idx])
-
-        # Calculate the size after subsampling and padding.
-        if key == Y:
-            padded_size = ((s // 8 + 1) * 8 if s % 8 else s for s in size)
-        else:
-            padded_size = ((s // 8 + 1) * 8 if s % 8 else s
-                           for s in subsampled_size)
-        # Combine the blocks into original image
-        data[key] = block_combine(layer, *padded_size)
-
-    # Inverse Level Offset
-    data[Y] = data[Y] + 128
-
-    # Clip Padded Image
-    data[Y] = data[Y][:size[0], :size[1]]
-    if not grey_level:
-        data[CB] = data[CB][:subsampled_size[0], :subsampled_size[1]]
-        data[CR] = data[CR][:subsampled_size[0], :subsampled_size[1]]
-
-        # Upsampling and Clipping
-        data[CB] = upsample(data[CB], subsampling_mode)[:size[0], :size[1]]
-        data[CR] = upsample(data[CR], subsampling_mode)[:size[0], :size[1]]
-
-        # Color Space Conversion
-        data = ycbcr2rgb(**data)
-
-    # Rounding, Clipping and Flatten
-    for k, v in data.items():  # pylint: disable=invalid-name
-        data[k] = np.rint(np.clip(v, 0, 255)).flatten()
-
-    logging.getLogger(__name__).info(
-        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
-    )
-    # Combine layers into signle raw data.
-    return (np.dstack((data.values()))
-            .flatten()
-            .astype(np.uint8))
+    return data
@@ -0,0 +1,422 @@
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+from multiprocessing import shared_memory
+import os
+import time
+
+from bitarray import bitarray, bits2bytes
+import numpy as np
+
+from . import _encode, _mcu_size, _quantize, _transform, compress, extract
+from .transcode import repack
+
+
+def compress_batch(file_objects, size, quality=50, grey_level=False,  # pylint: disable=too-many-arguments
+                   subsampling_mode=1, fixed_point=False, box_filter=False,
+                   compact=False, max_workers=1):
+    start_time = time.perf_counter()
+    logging.getLogger(__name__).info(
+        'Original file size: %d Bytes',
+        sum(os.fstat(f.fileno()).st_size for f in file_objects)
+    )
+
+    if quality <= 0 or quality > 95:
+        raise ValueError('Quality should within (0, 95].')
+
+    if not file_objects:
+        return []
+
+    options = {
+        'fixed_point': fixed_point,
+        'box_filter': box_filter,
+        'compact': compact
+    }
+    spec = {
+        'size': size,
+        'grey_level': grey_level,
+        'quality': quality,
+        'subsampling_mode': subsampling_mode
+    }
+
+    if max_workers == 1:
+        images = [
+            np.fromfile(f, dtype=np.uint8).reshape(
+                size if grey_level else (*size, 3)
+            )
+            for f in file_objects
+        ]
+        compressed = _compress_images(images, spec, **options)
+    else:
+        compressed = _compress_images_shared(file_objects, spec, max_workers,
+                                             **options)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def _compress_images(images, spec, fixed_point=False, box_filter=False,
+                     compact=False):
+    """Transform and quantize same-size images together and encode them one
+    by one.
+
+    Returns:
+        list -- The compressed result of each image.
+    """
+
+    grey_level = spec['grey_level']
+    subsampling_mode = spec['subsampling_mode']
+
+    if spec['size'][0] % _mcu_size(spec)[0] == 0:
+        # Stack MCU aligned images vertically, so that the blocks of each
+        # image are contiguous and neither subsampling nor padding crosses
+        # images, and transform them as one tall image.
+        coefficients = _transform(np.concatenate(images), grey_level,
+                                  subsampling_mode, fixed_point=fixed_point,
+                                  box_filter=box_filter, compact=compact)
+    else:
+        # Padding is per image, so only concatenate the transformed blocks.
+        transformed = [
+            _transform(img_arr, grey_level, subsampling_mode,
+                       fixed_point=fixed_point, box_filter=box_filter,
+                       compact=compact)
+            for img_arr in images
+        ]
+        coefficients = {
+            key: np.concatenate([data[key] for data in transformed])
+            for key in transformed[0]
+        }
+
+    # Quantize all the blocks at once and split them back into images.
+    quantized = {
+        key: np.split(layer, len(images))
+        for key, layer in _quantize(coefficients, spec['quality'],
+                                    compact=compact).items()
+    }
+    return [
+        _encode({key: layers[idx] for key, layers in quantized.items()}, spec)
+        for idx in range(len(images))
+    ]
+
+
+def _compress_images_shared(file_objects, spec, max_workers=None, **options):
+    """Compress same-size images in a process pool. The raw files are read
+    into a shared memory segment and each worker writes the data of its
+    images into their slots of a shared output arena, so only headers and
+    slot descriptors are pickled."""
+    shape = spec['size'] if spec['grey_level'] else (*spec['size'], 3)
+    image_bytes = int(np.prod(shape))
+    max_workers = max_workers or os.cpu_count() or 1
+
+    inputs = shared_memory.SharedMemory(
+        create=True, size=len(file_objects) * image_bytes
+    )
+    outputs = shared_memory.SharedMemory(
+        create=True, size=len(file_objects) * image_bytes
+    )
+    try:
+        _read_images(file_objects, inputs, image_bytes)
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            futures = [
+                executor.submit(_compress_shared_chunk, inputs.name,
+                                outputs.name, start, stop, shape, spec,
+                                options)
+                for start, stop in _chunks(len(file_objects), max_workers)
+            ]
+            compressed = [result for future in futures
+                          for result in future.result()]
+
+        for idx, result in enumerate(compressed):
+            with outputs.buf[idx * image_bytes:(idx + 1) * image_bytes] as buf:
+                _load_compressed(result, buf)
+    finally:
+        for segment in (inputs, outputs):
+            segment.close()
+            segment.unlink()
+    return compressed
+
+
+def _read_images(file_objects, segment, image_bytes):
+    """Read each raw file into its slot of `image_bytes` Bytes in a shared
+    memory segment."""
+    for idx, file_object in enumerate(file_objects):
+        with segment.buf[idx * image_bytes:(idx + 1) * image_bytes] as buf:
+            if file_object.readinto(buf) != image_bytes:
+                raise ValueError(
+                    f'File {idx} is smaller than {image_bytes} Bytes.'
+                )
+
+
+def _chunks(count, parts):
+    """Split the indices [0, count) into at most `parts` contiguous
+    [start, stop) ranges of about the same length."""
+    bounds = np.linspace(0, count, min(parts, count) + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _compress_shared_chunk(input_name, output_name, start, stop, shape, spec,  # pylint: disable=too-many-arguments
+                           options):
+    """Compress the images [start, stop) of a shared input segment and move
+    their data into the slots of the shared output arena."""
+    image_bytes = int(np.prod(shape))
+    inputs = shared_memory.SharedMemory(name=input_name)
+    outputs = shared_memory.SharedMemory(name=output_name)
+    try:
+        images = np.ndarray((stop - start, *shape), dtype=np.uint8,
+                            buffer=inputs.buf, offset=start * image_bytes)
+        compressed = _compress_images(images, spec, **options)
+        del images
+        for idx, result in enumerate(compressed, start):
+            with outputs.buf[idx * image_bytes:(idx + 1) * image_bytes] as buf:
+                _store_compressed(result, buf)
+    finally:
+        inputs.close()
+        outputs.close()
+    return compressed
+
+
+def repack_directory(directory, headers, output_directory, max_workers=None):
+    start_time = time.perf_counter()
+
+    os.makedirs(output_directory, exist_ok=True)
+    filenames = list(headers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        repacked_headers = dict(zip(filenames, executor.map(
+            _repack_file,
+            (os.path.join(directory, filename) for filename in filenames),
+            (os.path.join(output_directory, filename)
+             for filename in filenames),
+            (headers[filename] for filename in filenames)
+        )))
+
+    logging.getLogger(__name__).info(
+        'Repacked %d files: %d Bytes to %d Bytes', len(filenames),
+        sum(os.path.getsize(os.path.join(directory, filename))
+            for filename in filenames),
+        sum(os.path.getsize(os.path.join(output_directory, filename))
+            for filename in filenames)
+    )
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return repacked_headers
+
+
+def _repack_file(path, output_path, header):
+    """Repack a compressed file into the output path and return its new
+    header."""
+    with open(path, 'rb') as compressed_file:
+        repacked = repack(compressed_file, header)
+    with open(output_path, 'wb') as repacked_file:
+        repacked['data'].tofile(repacked_file)
+    return repacked['header']
+
+
+def compress_many(specs, max_workers=None, callback=None, shared=False):
+    return _run_many(_compress_spec, _load_compressed, specs,
+                     lambda spec: os.path.getsize(spec['fn']),
+                     max_workers=max_workers, callback=callback,
+                     shared=shared)
+
+
+def extract_many(specs, max_workers=None, callback=None, shared=False):
+    return _run_many(_extract_spec, _load_raw, specs,
+                     lambda spec: 3 * spec['header']['size'][0]
+                     * spec['header']['size'][1],
+                     max_workers=max_workers, callback=callback,
+                     shared=shared)
+
+
+def _run_many(worker, load, specs, output_bound, max_workers=None,  # pylint: disable=too-many-arguments,too-many-locals
+              callback=None, shared=False):
+    """Run the worker on the specs in a process pool, largest input file
+    first, pass each result to the callback as soon as it is done and return
+    the throughput statistics.
+
+    Only a bounded number of specs are in flight, so that millions of specs
+    do not create millions of pending futures. If `shared` is set, each
+    in-flight spec gets a slot of `output_bound` Bytes in a shared memory
+    arena, which the worker writes its result into and `load` reads it back
+    from, instead of pickling the result.
+    """
+    start_time = time.perf_counter()
+
+    specs = list(specs)
+    input_sizes = [os.path.getsize(spec['fn']) for spec in specs]
+    order = sorted(range(len(specs)), key=lambda idx: -input_sizes[idx])
+    stats = {'files': 0, 'pixels': 0, 'input_bytes': 0, 'output_bytes': 0}
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = 4 * max_workers
+    arena = None
+    if shared and specs:
+        capacity = max(output_bound(spec) for spec in specs)
+        arena = shared_memory.SharedMemory(create=True,
+                                           size=max_pending * capacity)
+    slots = list(range(max_pending))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            pending = {}
+            order = iter(order)
+            while True:
+                for idx in itertools.islice(order,
+                                            max_pending - len(pending)):
+                    slot = slots.pop()
+                    future = executor.submit(
+                        worker, specs[idx],
+                        None if arena is None
+                        else (arena.name, slot * capacity, capacity)
+                    )
+                    pending[future] = idx, slot
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    idx, slot = pending.pop(future)
+                    result, pixels, output_bytes = future.result()
+                    if arena is not None:
+                        with arena.buf[slot * capacity:
+                                       (slot + 1) * capacity] as buf:
+                            result = load(result, buf)
+                    slots.append(slot)
+                    stats['files'] += 1
+                    stats['pixels'] += pixels
+                    stats['input_bytes'] += input_sizes[idx]
+                    stats['output_bytes'] += output_bytes
+                    if callback is not None:
+                        callback(specs[idx], result)
+    finally:
+        if arena is not None:
+            arena.close()
+            arena.unlink()
+
+    stats['seconds'] = time.perf_counter() - start_time
+    stats['files_per_second'] = stats['files'] / stats['seconds']
+    stats['megapixels_per_second'] = stats['pixels'] / 1e6 / stats['seconds']
+    stats['input_bytes_per_second'] = stats['input_bytes'] / stats['seconds']
+    logging.getLogger(__name__).info(
+        'Processed %d files: %d Bytes to %d Bytes, %.2f files/s, %.2f MP/s',
+        stats['files'], stats['input_bytes'], stats['output_bytes'],
+        stats['files_per_second'], stats['megapixels_per_second']
+    )
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', stats['seconds']
+    )
+    return stats
+
+
+@contextlib.contextmanager
+def _arena_slot(slot):
+    """Attach to a slot (name, offset, capacity) of a shared memory arena and
+    yield it as a memoryview."""
+    name, offset, capacity = slot
+    arena = shared_memory.SharedMemory(name=name)
+    try:
+        with arena.buf[offset:offset + capacity] as buf:
+            yield buf
+    finally:
+        arena.close()
+
+
+def _compress_spec(spec, slot=None):
+    """Compress the raw file of a spec with the other keys of the spec as
+    arguments. If the spec has an output path, write the data into it and
+    only return the rest of the result. Otherwise, move the data into the
+    arena slot if given."""
+    kwargs = {key: value for key, value in spec.items()
+              if key not in ('fn', 'output')}
+    with open(spec['fn'], 'rb') as raw_file:
+        compressed = compress(raw_file, **kwargs)
+    output_bytes = bits2bytes(len(compressed['data']))
+    if 'output' in spec:
+        with open(spec['output'], 'wb') as compressed_file:
+            compressed.pop('data').tofile(compressed_file)
+    elif slot is not None:
+        with _arena_slot(slot) as buf:
+            _store_compressed(compressed, buf)
+    return compressed, spec['size'][0] * spec['size'][1], output_bytes
+
+
+def _extract_spec(spec, slot=None):
+    """Extract the compressed file of a spec with the other keys of the spec
+    as arguments. If the spec has an output path, write the raw data into it
+    and return None. Otherwise, move the raw data into the arena slot if
+    given."""
+    kwargs = {key: value for key, value in spec.items()
+              if key not in ('fn', 'output')}
+    with open(spec['fn'], 'rb') as compressed_file:
+        raw = extract(compressed_file, **kwargs)
+    if isinstance(raw, dict):  # planar
+        output_bytes = sum(plane.nbytes for plane in raw.values())
+    else:
+        output_bytes = raw.nbytes
+    if 'output' in spec:
+        with open(spec['output'], 'wb') as raw_file:
+            if isinstance(raw, dict):
+                for plane in raw.values():
+                    plane.tofile(raw_file)
+            else:
+                raw.tofile(raw_file)
+        raw = None
+    elif slot is not None:
+        with _arena_slot(slot) as buf:
+            raw = _store_raw(raw, buf)
+    size = spec['header']['size']
+    return raw, size[0] * size[1], output_bytes
+
+
+def _store_compressed(compressed, buf):
+    """Move the data of a compressed result into the buffer, leaving its bit
+    length in its place. Data larger than the buffer is kept."""
+    data = compressed['data']
+    nbytes = bits2bytes(len(data))
+    if nbytes <= len(buf):
+        with memoryview(data) as view:
+            buf[:nbytes] = view[:nbytes]
+        compressed['data'] = len(data)
+    return compressed
+
+
+def _load_compressed(compressed, buf):
+    """Read the data moved into the buffer by `_store_compressed` back. Results
+    whose data was written to an output file are returned unchanged."""
+    if isinstance(compressed.get('data'), int):
+        length = compressed['data']
+        compressed['data'] = bitarray()
+        compressed['data'].frombytes(bytes(buf[:bits2bytes(length)]))
+        del compressed['data'][length:]
+    return compressed
+
+
+def _store_raw(raw, buf):
+    """Copy the raw data, or the planes in planar mode, into the buffer and
+    return a tuple of (key, shape, dtype) describing them. Data larger than
+    the buffer is returned as is."""
+    planes = raw if isinstance(raw, dict) else {None: raw}
+    if sum(plane.nbytes for plane in planes.values()) > len(buf):
+        return raw
+    offset = 0
+    for plane in planes.values():
+        np.ndarray(plane.shape, dtype=plane.dtype, buffer=buf,
+                   offset=offset)[...] = plane
+        offset += plane.nbytes
+    return tuple((key, plane.shape, plane.dtype.str)
+                 for key, plane in planes.items())
+
+
+def _load_raw(raw, buf):
+    """Copy the raw data described by `_store_raw` out of the buffer."""
+    if not isinstance(raw, tuple):
+        return raw
+    planes = {}
+    offset = 0
+    for key, shape, dtype in raw:
+        planes[key] = np.ndarray(shape, dtype=dtype, buffer=buf,
+                                 offset=offset).copy()
+        offset += planes[key].nbytes
+    return planes[None] if None in planes else planes
@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 import itertools
 
 from bidict import bidict
@@ -15,8 +15,44 @@ LUMINANCE = frozenset({Y})
 CHROMINANCE = frozenset({CB, CR})
 
 
+class BlockCache:
+    def __init__(self, maxsize=4096):
+        """Create a bounded LRU cache mapping quantized blocks to their encoded
+        bit sequence.
+
+        Keyword Arguments:
+            maxsize {int} -- The maximum number of cached blocks. The least
+                recently used block is discarded when exceeded. (default: {4096})
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        """Return the cached value of `key` or `None` on miss."""
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
 class Encoder:
-    def __init__(self, data, layer_type):
+    def __init__(self, data, layer_type, ac_cache=None, codeword=None):
         """Create a encoder based on baseline JPEG Huffman table.
 
         Arguments:
@@ -25,10 +61,20 @@ class Encoder:
                 {DC: '..010..', AC: '..010..', }
             layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
                 data.
+
+        Keyword Arguments:
+            ac_cache {BlockCache} -- The cache of encoded AC of blocks. Pass the
+                same cache to share it between encoders with the same Huffman
+                table. (default: {None})
+            codeword {dict} -- The Huffman table in the format
+                {DC: bidict(...), AC: bidict(...)} to replace the baseline one.
+                (default: {None})
         """
 
         self.data = data
         self.layer_type = layer_type
+        self.ac_cache = BlockCache() if ac_cache is None else ac_cache
+        self.codeword = codeword
         # List containing differential DCs for multiple blocks.
         self._diff_dc = None
         # List containing run-length-encoding AC pairs for multiple blocks.
@@ -66,12 +112,27 @@ class Encoder:
         """
 
         ret = {}
-        ret[DC] = ''.join(encode_huffman(v, self.layer_type)
+        ret[DC] = ''.join(encode_huffman(v, self.layer_type, self.codeword)
                           for v in self.diff_dc)
-        ret[AC] = ''.join(encode_huffman(v, self.layer_type)
-                          for v in self.run_length_ac)
+        if self._run_length_ac is None:
+            # AC of a block does not depend on other blocks, reuse the encoded
+            # AC of identical blocks.
+            ret[AC] = ''.join(self._encode_ac(block) for block in self.data)
+        else:
+            ret[AC] = ''.join(encode_huffman(v, self.layer_type, self.codeword)
+                              for v in self.run_length_ac)
         return ret
 
+    def _encode_ac(self, block):
+        # DC is coded separately, only AC are used as the key.
+        key = (self.layer_type, block.ravel()[1:].tobytes())
+        encoded = self.ac_cache.get(key)
+        if encoded is None:
+            encoded = ''.join(encode_huffman(v, self.layer_type, self.codeword)
+                              for v in run_length_ac_of_block(block))
+            self.ac_cache.put(key, encoded)
+        return encoded
+
     def _get_diff_dc(self):
         """Calculate the differential DC of given data."""
         self._diff_dc = tuple(encode_differential(self.data[:, 0, 0]))
@@ -80,13 +141,11 @@ class Encoder:
         """Calculate the run-length-encoded AC of given data."""
         self._run_length_ac = []
         for block in self.data:
-            self._run_length_ac.extend(
-                encode_run_length(tuple(iter_zig_zag(block))[1:])
-            )
+            self._run_length_ac.extend(run_length_ac_of_block(block))
 
 
 class Decoder:
-    def __init__(self, data, layer_type):
+    def __init__(self, data, layer_type, dtype=int, codeword=None):
         """Create a decoder based on baseline JPEG Huffman table.
 
         Arguments:
@@ -95,10 +154,19 @@ class Decoder:
                 {DC: '.01..', AC: '.01..'}
             layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
                 data.
+
+        Keyword Arguments:
+            dtype {data-type} -- The integer type of decoded blocks.
+                (default: {int})
+            codeword {dict} -- The Huffman table in the format
+                {DC: bidict(...), AC: bidict(...)} to replace the baseline one.
+                (default: {None})
         """
 
         self.data = data
         self.layer_type = layer_type
+        self.dtype = dtype
+        self.codeword = codeword
 
         # A list containing all DC of blocks.
         self._dc = None
@@ -118,8 +186,11 @@ class Decoder:
             raise ValueError(f'DC size {len(self.dc)} is not equal to AC size '
                              f'{len(self.ac)}.')
 
-        shaped = np.array(tuple(inverse_iter_zig_zag((dc, ) + ac, size=8)
-                                for dc, ac in zip(self.dc, self.ac)))
+        shaped = np.array(
+            tuple(inverse_iter_zig_zag((dc, ) + ac, size=8, dtype=self.dtype)
+                  for dc, ac in zip(self.dc, self.ac)),
+            dtype=self.dtype
+        )
 
         return shaped
 
@@ -139,7 +210,8 @@ class Decoder:
         self._dc = tuple(decode_differential(decode_huffman(
             self.data[DC],
             DC,
-            self.layer_type
+            self.layer_type,
+            self.codeword
         )))
 
     def _get_ac(self):
@@ -152,12 +224,101 @@ class Decoder:
                     ret = []
 
         self._ac = tuple(decode_run_length(pairs) for pairs in isplit(
-            decode_huffman(self.data[AC], AC, self.layer_type),
+            decode_huffman(self.data[AC], AC, self.layer_type, self.codeword),
             EOB
         ))
 
 
-def encode_huffman(value, layer_type):
+def count_bits(data, layer_type):
+    """Count the length of Huffman encoded differential DC and
+    run-length-encoded AC of given blocks without encoding them.
+
+    Arguments:
+        data {3D np.array} -- A list of quantized blocks.
+        layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
+            data.
+
+    Returns:
+        dict -- A dictionary containing the bit lengths of DC and AC. The
+            format is:
+            ```
+            ret = {DC: 123, AC: 456}
+            ```
+    """
+
+    return {k: int(v.sum())
+            for k, v in block_bit_lengths(data, layer_type).items()}
+
+
+def block_bit_lengths(data, layer_type):
+    """Calculate the Huffman encoded bit length of DC and AC of each block with
+    vectorized operations. The result is the same as the length of encoded bits
+    by `Encoder`.
+
+    Arguments:
+        data {3D np.array} -- A list of quantized blocks.
+        layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
+            data.
+
+    Returns:
+        dict -- A dictionary containing the bit lengths of DC and AC of each
+            block in 1D arrays. The format is:
+            ```
+            ret = {DC: np.array([...]), AC: np.array([...])}
+            ```
+    """
+
+    code_lengths = HUFFMAN_CODE_LENGTHS[layer_type]
+    dc_sizes, ac_blocks, ac_runs, ac_sizes = _symbolize(data)
+
+    # Differential DC: codeword + fixed code of its size (category).
+    dc_bits = code_lengths[DC][dc_sizes] + dc_sizes
+
+    # Run-length-encoded AC: every nonzero AC with the zeros run before it,
+    # where each 16 zeros in the run would be a ZRL, and EOB for each block.
+    symbol_bits = (code_lengths[AC][ac_runs % 16, ac_sizes] + ac_sizes
+                   + ac_runs // 16 * code_lengths[AC][ZRL])
+    ac_bits = (np.bincount(ac_blocks, weights=symbol_bits, minlength=len(data))
+               .astype(int) + code_lengths[AC][EOB])
+    return {DC: dc_bits, AC: ac_bits}
+
+
+def _symbolize(data):
+    """Generate the Huffman symbols of given blocks with vectorized operations.
+
+    Returns:
+        tuple -- The sizes (categories) of differential DC of each block, and
+            the block indices, zeros runs (including the ones for ZRL) and
+            sizes of nonzero AC.
+    """
+    data = np.asarray(data).reshape(len(data), -1)
+    dc_sizes = huffman_category(np.diff(data[:, 0].astype(int), prepend=0))
+
+    acs = data[:, ZIG_ZAG_ORDER[1:]]
+    blocks, cols = np.nonzero(acs)
+    previous_cols = np.empty_like(cols)
+    previous_cols[1:] = cols[:-1]
+    first_in_block = np.ones(len(blocks), dtype=bool)
+    first_in_block[1:] = blocks[1:] != blocks[:-1]
+    previous_cols[first_in_block] = -1
+    return (dc_sizes, blocks, cols - previous_cols - 1,
+            huffman_category(acs[blocks, cols]))
+
+
+def huffman_category(values):
+    """Return the category (size) of the values in Huffman coding, which is the
+    bit length of their absolute values."""
+    return np.frexp(np.abs(values))[1]
+
+
+def run_length_ac_of_block(block):
+    if not block.flat[1:].any():
+        # Flat block: all AC are zero.
+        return [EOB]
+    return encode_run_length(tuple(iter_zig_zag(block))[1:])
+
+
+def encode_huffman(value, layer_type, codeword=None):
     """Encode the Huffman coding of value.
 
     Arguments:
@@ -165,6 +326,11 @@ def encode_huffman(value, layer_type):
         layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
             value.
 
+    Keyword Arguments:
+        codeword {dict} -- The Huffman table in the format
+            {DC: bidict(...), AC: bidict(...)}. (default: {None}, the baseline
+            table of `layer_type`)
+
     Raises:
         ValueError -- When the value is out of the range.
 
@@ -179,7 +345,11 @@ def encode_huffman(value, layer_type):
                     return (i, j)
         raise ValueError('Cannot find the target value in the table.')
 
-    if not isinstance(value, collections.Iterable):  # DC
+    if codeword is None:
+        codeword = {dc_ac: HUFFMAN_CATEGORY_CODEWORD[dc_ac][layer_type]
+                    for dc_ac in (DC, AC)}
+
+    if not isinstance(value, collections.abc.Iterable):  # DC
         if value <= -2048 or value >= 2048:
             raise ValueError(
                 f'Differential DC {value} should be within [-2047, 2047].'
@@ -188,13 +358,13 @@ def encode_huffman(value, layer_type):
         size, fixed_code_idx = index_2d(HUFFMAN_CATEGORIES, value)
 
         if size == 0:
-            return HUFFMAN_CATEGORY_CODEWORD[DC][layer_type][size]
-        return (HUFFMAN_CATEGORY_CODEWORD[DC][layer_type][size]
+            return codeword[DC][size]
+        return (codeword[DC][size]
                 + '{:0{padding}b}'.format(fixed_code_idx, padding=size))
     # AC
     value = tuple(value)
     if value in (EOB, ZRL):
-        return HUFFMAN_CATEGORY_CODEWORD[AC][layer_type][value]
+        return codeword[AC][value]
 
     run, nonzero = value
     if nonzero == 0 or nonzero <= -1024 or nonzero >= 1024:
@@ -204,11 +374,11 @@ def encode_huffman(value, layer_type):
         )
 
     size, fixed_code_idx = index_2d(HUFFMAN_CATEGORIES, nonzero)
-    return (HUFFMAN_CATEGORY_CODEWORD[AC][layer_type][(run, size)]
+    return (codeword[AC][(run, size)]
             + '{:0{padding}b}'.format(fixed_code_idx, padding=size))
 
 
-def decode_huffman(bit_seq, dc_ac, layer_type):
+def decode_huffman(bit_seq, dc_ac, layer_type, codeword=None):
     """Decode a bit sequence encoded by JPEG baseline Huffman table.
 
     Arguments:
@@ -216,6 +386,11 @@ def decode_huffman(bit_seq, dc_ac, layer_type):
         dc_ac {DC or AC} -- The type of current.
         layer_type {LUMINANCE or CHROMINANCE} -- The layer type of bit sequence.
 
+    Keyword Arguments:
+        codeword {dict} -- The Huffman table in the format
+            {DC: bidict(...), AC: bidict(...)}. (default: {None}, the baseline
+            table of `layer_type`)
+
     Raises:
         IndexError -- When there is not enough bits in bit sequence to decode
             DIFF value codeword.
@@ -234,6 +409,11 @@ def decode_huffman(bit_seq, dc_ac, layer_type):
         fixed = bit_seq[idx:idx + size]
         return int(fixed, 2)
 
+    if codeword is None:
+        codeword = HUFFMAN_CATEGORY_CODEWORD[dc_ac][layer_type]
+    else:
+        codeword = codeword[dc_ac]
+
     current_idx = 0
     while current_idx < len(bit_seq):
         #   1. Consume next 16 bits as `current_slice`.
@@ -250,10 +430,8 @@ def decode_huffman(bit_seq, dc_ac, layer_type):
         ]
         err_cache = current_slice
         while current_slice:
-            if (current_slice in
-                    HUFFMAN_CATEGORY_CODEWORD[dc_ac][layer_type].inv):
-                key = (HUFFMAN_CATEGORY_CODEWORD[dc_ac][layer_type]
-                       .inv[current_slice])
+            if current_slice in codeword.inv:
+                key = codeword.inv[current_slice]
                 if dc_ac == DC:  # DC
                     size = key
                     if size == 0:
@@ -339,7 +517,7 @@ def iter_zig_zag(data):
             )
 
 
-def inverse_iter_zig_zag(seq, size=None, fill=0):
+def inverse_iter_zig_zag(seq, size=None, fill=0, dtype=int):
     def smallest_square_larger_than(value):  # pylint: disable=inconsistent-return-statements
         for ret in itertools.count():
             if ret**2 >= value:
@@ -348,7 +526,7 @@ def inverse_iter_zig_zag(seq, size=None, fill=0):
     if size is None:
         size = smallest_square_larger_than(len(seq))
     seq = tuple(seq) + (fill, ) * (size**2 - len(seq))
-    ret = np.empty((size, size), dtype=int)
+    ret = np.empty((size, size), dtype=dtype)
     x, y = 0, 0  # pylint: disable=invalid-name
     for value in seq:
         ret[y][x] = value
@@ -778,3 +956,27 @@ HUFFMAN_CATEGORY_CODEWORD = {
         })
     }
 }
+
+
+def huffman_code_lengths(layer_type, dc_ac):
+    """Return the codeword lengths of the default Huffman table of a layer in
+    an array indexed by size (DC) or (run, size) (AC)."""
+    codeword = HUFFMAN_CATEGORY_CODEWORD[dc_ac][layer_type]
+    if dc_ac == DC:
+        lengths = np.zeros(12, dtype=int)
+    else:
+        lengths = np.zeros((16, 11), dtype=int)
+    for key, code in codeword.items():
+        lengths[key] = len(code)
+    return lengths
+
+
+HUFFMAN_CODE_LENGTHS = {
+    layer_type: {
+        dc_ac: huffman_code_lengths(layer_type, dc_ac)
+        for dc_ac in (DC, AC)
+    }
+    for layer_type in (LUMINANCE, CHROMINANCE)
+}
+
+ZIG_ZAG_ORDER = np.array(tuple(iter_zig_zag(np.arange(64).reshape(8, 8))))
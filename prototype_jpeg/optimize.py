@@ -0,0 +1,233 @@
+import collections
+import heapq
+
+from bidict import bidict
+import numpy as np
+
+from .codec import (_symbolize, huffman_category, AC, DC, EOB, ZRL,
+                    HUFFMAN_CODE_LENGTHS, ZIG_ZAG_ORDER)
+
+
+def symbol_histogram(data):
+    """Count the Huffman symbols of differential DC and run-length-encoded AC
+    of given blocks without encoding them.
+
+    Arguments:
+        data {3D np.array} -- A list of quantized blocks.
+
+    Returns:
+        dict -- A dictionary containing the counters of DC symbols (size) and
+            AC symbols ((run, size), `EOB` or `ZRL`). The format is:
+            ```
+            ret = {DC: Counter({0: 12, ...}), AC: Counter({EOB: 34, ...})}
+            ```
+    """
+
+    dc_sizes, _, ac_runs, ac_sizes = _symbolize(data)
+    ac_symbols, ac_counts = np.unique(
+        np.stack((ac_runs % 16, ac_sizes), axis=1), axis=0, return_counts=True
+    )
+    ac_histogram = collections.Counter({
+        tuple(symbol.tolist()): int(count)
+        for symbol, count in zip(ac_symbols, ac_counts)
+    })
+    ac_histogram[EOB] = len(data)
+    if (ac_runs >= 16).any():
+        ac_histogram[ZRL] = int((ac_runs // 16).sum())
+    return {
+        DC: collections.Counter(dict(zip(
+            *(v.tolist() for v in np.unique(dc_sizes, return_counts=True))
+        ))),
+        AC: ac_histogram
+    }
+
+
+def optimize_quantization(data, layer_type, lagrangian=0.08, dtype=int):
+    """Round quantized (but not yet rounded) blocks with rate-distortion
+    optimization instead of uniform rounding.
+
+    Starting from the rounded blocks, each pass takes the AC change of every
+    block with the largest gain, either zeroing a nonzero AC or lowering its
+    level by one, until no change pays off. The gain of a change is
+    `lagrangian * saved_bits - increased_distortion`, where the saved bits are
+    counted with the Huffman code lengths (including the merged zeros run and
+    ZRL) and the distortion is the squared error in quantization steps. DC is
+    always uniformly rounded.
+
+    Arguments:
+        data {3D np.array} -- A list of quantized blocks before rounding.
+        layer_type {LUMINANCE or CHROMINANCE} -- Specify the layer type of
+            data.
+
+    Keyword Arguments:
+        lagrangian {float} -- The distortion (squared quantization steps) a
+            saved bit is worth. (default: {0.08})
+        dtype {type} -- The data type of the result. (default: {int})
+
+    Returns:
+        3D np.array -- The rounded quantized blocks.
+    """
+
+    code_lengths = HUFFMAN_CODE_LENGTHS[layer_type][AC]
+    data = np.asarray(data).reshape(len(data), -1)
+    ret = np.rint(data).astype(dtype)
+    scaled = data[:, ZIG_ZAG_ORDER[1:]]
+    acs = ret[:, ZIG_ZAG_ORDER[1:]].astype(int)
+
+    while True:
+        blocks, cols, changed, gain = _ac_changes(acs, scaled, code_lengths,
+                                                  lagrangian)
+        if not blocks.size:
+            break
+
+        # Take the change with the largest gain of each block.
+        order = np.lexsort((gain, blocks))
+        best = order[np.append(blocks[order][1:] != blocks[order][:-1], True)]
+        best = best[gain[best] > 0]
+        if not best.size:
+            break
+        acs[blocks[best], cols[best]] = changed[best]
+
+    ret[:, ZIG_ZAG_ORDER[1:]] = acs
+    return ret.reshape((-1, 8, 8))
+
+
+def _ac_changes(acs, scaled, code_lengths, lagrangian):
+    """Find the better change of zeroing and lowering for each nonzero AC.
+
+    Returns:
+        tuple -- The block indices, zig-zag indices, changed values and gains
+            of the changes.
+    """
+    blocks, cols = np.nonzero(acs)
+    values, targets = acs[blocks, cols], scaled[blocks, cols]
+    runs, bits, zero_bits = _zeroing_bits(code_lengths, blocks, cols,
+                                          huffman_category(values))
+    zero_gain = (lagrangian * zero_bits
+                 - targets ** 2 + (targets - values) ** 2)
+
+    # Lowering the level only saves bits when its size decreases.
+    lowered = values - np.sign(values)
+    lower_gain = (lagrangian * (bits - _ac_symbol_bits(
+        code_lengths, runs, huffman_category(lowered)))
+                  - (targets - lowered) ** 2 + (targets - values) ** 2)
+    lower_gain[lowered == 0] = -np.inf
+
+    lower = lower_gain > zero_gain
+    return (blocks, cols, np.where(lower, lowered, 0),
+            np.where(lower, lower_gain, zero_gain))
+
+
+def _zeroing_bits(code_lengths, blocks, cols, sizes):
+    """Count the bits of each nonzero AC and the bits saved by zeroing it.
+
+    Zeroing merges the zeros run before it into the one of the next nonzero AC
+    of the same block, or into EOB if it is the last one.
+
+    Returns:
+        tuple -- The zeros runs before, the bits and the saved bits of the
+            nonzero AC.
+    """
+    first_in_block = np.ones(len(blocks), dtype=bool)
+    first_in_block[1:] = blocks[1:] != blocks[:-1]
+    last_in_block = np.roll(first_in_block, -1)
+    runs = np.diff(cols, prepend=-1) - 1
+    runs[first_in_block] = cols[first_in_block]
+    next_runs = np.roll(runs, -1)
+    next_sizes = np.roll(sizes, -1)
+    bits = _ac_symbol_bits(code_lengths, runs, sizes)
+    saved = bits + np.where(
+        last_in_block, 0,
+        _ac_symbol_bits(code_lengths, next_runs, next_sizes)
+        - _ac_symbol_bits(code_lengths, runs + next_runs + 1, next_sizes)
+    )
+    return runs, bits, saved
+
+
+def _ac_symbol_bits(code_lengths, runs, sizes):
+    """Count the bits of AC with the zeros runs before them, where each 16
+    zeros in a run is a ZRL."""
+    return (code_lengths[runs % 16, sizes] + sizes
+            + runs // 16 * code_lengths[ZRL])
+
+
+def optimize_huffman_table(histogram):
+    """Generate the Huffman table of code lengths limited to 16 bits for the
+    symbol histogram as JPEG Annex K.2 and K.3, where no codeword consists of
+    all 1 bits.
+
+    Arguments:
+        histogram {Counter} -- The counter of symbols, e.g. the result of
+            `symbol_histogram`.
+
+    Returns:
+        tuple -- The numbers of codewords of each length from 1 to 16 bits
+            and the symbols in the order of their codeword lengths, which is
+            the same as the DHT segment of JPEG.
+    """
+
+    # A reserved symbol of frequency 1 takes the longest codeword, which is
+    # the one of all 1 bits, and is removed at the end.
+    reserved = object()
+    frequencies = [(count, symbol) for symbol, count in histogram.items()
+                   if count]
+    frequencies.sort(key=lambda item: (-item[0], item[1]))
+    frequencies.append((1, reserved))
+
+    # Huffman code lengths by merging the two least frequent trees, where the
+    # later symbols are merged first among the same frequencies, so that the
+    # reserved symbol is in the first merged pair and has the longest code.
+    lengths = [0] * len(frequencies)
+    heap = [(count, -idx, [idx]) for idx, (count, _) in enumerate(frequencies)]
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        count1, _, members1 = heapq.heappop(heap)
+        count2, tie, members2 = heapq.heappop(heap)
+        for idx in members1 + members2:
+            lengths[idx] += 1
+        heapq.heappush(heap, (count1 + count2, tie, members1 + members2))
+
+    # Symbols are ordered from the most frequent one to the least frequent one
+    # (the reserved one).
+    order = sorted(range(len(frequencies)),
+                   key=lambda idx: (lengths[idx], idx))
+    return (_limit_code_lengths(lengths),
+            tuple(frequencies[idx][1] for idx in order[:-1]))
+
+
+def _limit_code_lengths(lengths):
+    """Count the codewords of each length from 1 to 16 bits after limiting
+    the code lengths to 16 bits by moving pairs of the longest codewords up
+    (Annex K.3 Adjust_BITS), and remove the reserved longest codeword."""
+    bits = [0] * (max(lengths) + 1)
+    for length in lengths:
+        bits[length] += 1
+    for i in range(len(bits) - 1, 16, -1):
+        while bits[i]:
+            j = i - 2
+            while not bits[j]:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+    bits = (bits + [0] * 17)[1:17]
+    bits[max(i for i, count in enumerate(bits) if count)] -= 1
+    return tuple(bits)
+
+
+def huffman_codeword(counts, symbols):
+    """Generate the canonical Huffman codewords of a table generated by
+    `optimize_huffman_table`.
+
+    Returns:
+        bidict -- The codewords of the symbols.
+    """
+    ret = bidict()
+    code, symbols = 0, iter(symbols)
+    for length, count in enumerate(counts, start=1):
+        for _ in range(count):
+            ret[next(symbols)] = '{:0{padding}b}'.format(code, padding=length)
+            code += 1
+        code <<= 1
+    return ret
@@ -0,0 +1,316 @@
+import logging
+import time
+
+from bitarray import bitarray
+import numpy as np
+
+from . import (_block_grid, _decode, _decode_bits, _encode, _layer_sizes,
+               _log_compressed_size, _mcu_size)
+from .utils import (quantize, scaled_quantization_table, reorient_blocks,
+                    downscale_blocks, ORIENTATIONS, Y)
+
+
+def requantize(file_object, header, quality):
+    start_time = time.perf_counter()
+    _log_compressed_size(file_object)
+
+    if quality <= 0 or quality > 95:
+        raise ValueError('Quality should within (0, 95].')
+
+    data = _decode(file_object, header)
+
+    # Rescale the quantized coefficients by the ratio of quantization tables
+    # without going back to the pixel domain.
+    transposed = header.get('transposed', False)
+    for key, layer in data.items():
+        data[key] = np.rint(quantize(
+            quantize(layer, key, quality=header['quality'], inverse=True,
+                     transposed=transposed),
+            key,
+            quality=quality,
+            transposed=transposed
+        )).astype(int)
+
+    compressed = _encode(data, {**header, 'quality': quality})
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def reorient(file_object, header, operation):
+    start_time = time.perf_counter()
+
+    if operation not in ORIENTATIONS:
+        raise ValueError(f'Unknown operation {operation!r}, which should be '
+                         f'one of {", ".join(ORIENTATIONS)}.')
+    transposes = 'transpose' in ORIENTATIONS[operation]
+    if transposes and header['subsampling_mode'] == 2:
+        raise ValueError('Cannot transpose horizontally subsampled images.')
+    sizes = _layer_sizes(header)
+    if any(length % 8 for size in sizes.values() for length in size):
+        raise ValueError('The size of each layer should be a multiple of 8.')
+
+    data = _decode(file_object, header)
+
+    # Permute the blocks and transpose or sign-flip their coefficients. The
+    # differential DC is recomputed by the entropy encoder.
+    for key, layer in data.items():
+        data[key] = reorient_blocks(layer, *sizes[key], operation)
+
+    # The coefficients of transposed images are quantized by the transposed
+    # quantization tables.
+    compressed = _encode(data, {
+        **header,
+        'size': tuple(reversed(header['size'])) if transposes
+                else header['size'],
+        'transposed': header.get('transposed', False) != transposes
+    })
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def crop(file_object, header, rect):
+    start_time = time.perf_counter()
+
+    _check_aligned(header, rect)
+    top, left = rect[:2]
+    mcu_size = _mcu_size(header)
+    cropped_header = {**header, 'size': tuple(rect[2:])}
+    sizes = _layer_sizes(header)
+    cropped_sizes = _layer_sizes(cropped_header)
+    data = _decode(file_object, header)
+
+    # Select the blocks inside the rectangle. The differential DC is
+    # recomputed by the entropy encoder.
+    for key, layer in data.items():
+        # Chrominance blocks cover the MCUs.
+        block_size = (8, 8) if key == Y else mcu_size
+        data[key] = _crop_blocks(
+            layer,
+            sizes[key],
+            (top // block_size[0], left // block_size[1]),
+            cropped_sizes[key]
+        )
+
+    compressed = _encode(data, cropped_header)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def _crop_blocks(layer, size, origin, cropped_size):
+    """Select the blocks of a layer covering the cropped size from the block
+    at the origin (row, column)."""
+    row, col = origin
+    nrows, ncols = (-(-length // 8) for length in cropped_size)
+    return _block_grid(layer, size)[
+        row:row + nrows, col:col + ncols
+    ].reshape(-1, 8, 8)
+
+
+def stitch(images, layout):
+    start_time = time.perf_counter()
+
+    nrows, ncols = layout
+    if len(images) != nrows * ncols:
+        raise ValueError(f'The number of images ({len(images)}) does not fit '
+                         f'the layout {nrows}x{ncols}.')
+    headers = [header for _, header in images]
+    heights, widths = _check_layout(headers, layout)
+
+    grids = [
+        {key: _block_grid(layer, _layer_sizes(header)[key])
+         for key, layer in _decode(file_object, header).items()}
+        for file_object, header in images
+    ]
+
+    # Concatenate the block grids of each layer. The differential DC is
+    # recomputed by the entropy encoder.
+    data = {
+        key: np.concatenate([
+            np.concatenate([grid[key] for grid in grids[row:row + ncols]],
+                           axis=1)
+            for row in range(0, len(grids), ncols)
+        ]).reshape((-1, 8, 8))
+        for key in grids[0]
+    }
+
+    compressed = _encode(data, {**headers[0],
+                                'size': (sum(heights), sum(widths))})
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def _check_layout(headers, layout):
+    """Check that the images of the headers can be stitched in the layout.
+
+    Returns:
+        tuple -- The heights of the rows and the widths of the columns.
+    """
+    nrows, ncols = layout
+    spec_keys = ('grey_level', 'quality', 'subsampling_mode', 'transposed')
+    if any(header.get(key) != headers[0].get(key)
+           for header in headers for key in spec_keys):
+        raise ValueError('The images should share the grey level, quality, '
+                         'subsampling mode and orientation.')
+
+    # Images in the same row share the height, and the ones in the same
+    # column share the width. Each image is a box of the stitched image, so
+    # only the heights of the bottom row and the widths of the right column
+    # can be unaligned to MCUs.
+    heights = [headers[row * ncols]['size'][0] for row in range(nrows)]
+    widths = [headers[col]['size'][1] for col in range(ncols)]
+    stitched = {**headers[0], 'size': (sum(heights), sum(widths))}
+    for idx, header in enumerate(headers):
+        row, col = divmod(idx, ncols)
+        if tuple(header['size']) != (heights[row], widths[col]):
+            raise ValueError(f'The size of image {idx} does not fit the row '
+                             f'and the column of the layout.')
+        _check_aligned(stitched, (sum(heights[:row]), sum(widths[:col]),
+                                  heights[row], widths[col]))
+    return heights, widths
+
+
+def _check_aligned(header, box):
+    """Check that the box (top, left, height, width) is inside the image and
+    on MCU boundaries, except that its bottom and right edges can be the ones
+    of the image."""
+    top, left, height, width = box
+    size = header['size']
+    bottom, right = top + height, left + width
+    if (min(top, left) < 0 or min(height, width) <= 0
+            or bottom > size[0] or right > size[1]):
+        raise ValueError(f'The box {box} is out of the image.')
+    mcu_size = _mcu_size(header)
+    edges = (top, left, 0 if bottom == size[0] else bottom,
+             0 if right == size[1] else right)
+    if any(edge % length for edge, length in zip(edges, mcu_size * 2)):
+        raise ValueError(f'The box {box} is not aligned to '
+                         f'{mcu_size[0]}x{mcu_size[1]} MCUs.')
+
+
+def downscale(file_object, header, quality=None):  # pylint: disable=too-many-locals
+    start_time = time.perf_counter()
+
+    if quality is None:
+        quality = header['quality']
+    if quality <= 0 or quality > 95:
+        raise ValueError('Quality should within (0, 95].')
+
+    size = tuple(header['size'])
+    downscaled_header = {**header, 'size': tuple(-(-length // 2)
+                                                 for length in size),
+                         'quality': quality}
+    sizes = _layer_sizes(header)
+    downscaled_sizes = _layer_sizes(downscaled_header)
+    transposed = header.get('transposed', False)
+    data = _decode(file_object, header)
+
+    for key, layer in data.items():
+        # Pad the block grid with zero blocks to 2x the downscaled one.
+        nrows, ncols = (-(-length // 8) * 2 for length in downscaled_sizes[key])
+        grid = _block_grid(
+            quantize(layer, key, quality=header['quality'], inverse=True,
+                     transposed=transposed),
+            sizes[key]
+        )
+        grid = np.pad(grid, ((0, nrows - grid.shape[0]),
+                             (0, ncols - grid.shape[1]), (0, 0), (0, 0)))
+
+        # Build each block from 2x2 blocks in DCT domain and requantize it.
+        data[key] = np.rint(quantize(
+            downscale_blocks(grid, nrows, ncols),
+            key,
+            quality=quality,
+            transposed=transposed
+        )).astype(int)
+
+    compressed = _encode(data, downscaled_header)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def extract_coefficients(file_object, header):
+    start_time = time.perf_counter()
+
+    data = _decode(file_object, header, dtype=np.int16)
+    tables = {key: scaled_quantization_table(
+        key,
+        header['quality'],
+        transposed=header.get('transposed', False)
+    ) for key in data}
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return {'coefficients': data, 'quantization_tables': tables}
+
+
+def compress_coefficients(coefficients, size, quality=50, grey_level=False,  # pylint: disable=too-many-arguments
+                          subsampling_mode=1, transposed=False):
+    start_time = time.perf_counter()
+
+    if quality <= 0 or quality > 95:
+        raise ValueError('Quality should within (0, 95].')
+
+    spec = {
+        'size': size,
+        'grey_level': grey_level,
+        'quality': quality,
+        'subsampling_mode': subsampling_mode,
+        'transposed': transposed
+    }
+    sizes = _layer_sizes(spec)
+    if set(coefficients) != set(sizes):
+        raise ValueError(f'The layers should be {", ".join(sizes)}.')
+    for key, layer in coefficients.items():
+        nblocks = -(-sizes[key][0] // 8) * -(-sizes[key][1] // 8)
+        if np.shape(layer) != (nblocks, 8, 8):
+            raise ValueError(f'The shape of layer {key} {np.shape(layer)} '
+                             f'should be {(nblocks, 8, 8)}.')
+
+    compressed = _encode(coefficients, spec)
+
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
+
+
+def repack(file_object, header):
+    start_time = time.perf_counter()
+    _log_compressed_size(file_object)
+
+    data = _decode(file_object, header)
+    compressed = _encode(data, header, optimize_huffman=True)
+
+    # Verify the repacked bits, padded to bytes as in a file, decode to the
+    # same coefficients.
+    bits = bitarray()
+    bits.frombytes(compressed['data'].tobytes())
+    repacked = _decode_bits(bits, compressed['header'])
+    if any(not np.array_equal(repacked[key], layer)
+           for key, layer in data.items()):
+        raise ValueError('The repacked coefficients differ from the original '
+                         'ones.')
+
+    logging.getLogger(__name__).info(
+        'Repacked file size: %d Bytes', len(compressed['data'].tobytes())
+    )
+    logging.getLogger(__name__).info(
+        'Time elapsed: %.4f seconds', (time.perf_counter() - start_time)
+    )
+    return compressed
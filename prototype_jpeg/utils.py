@@ -1,4 +1,5 @@
 import collections
+import itertools
 import math
 
 from matplotlib import pyplot as plt
@@ -11,7 +12,40 @@ Y, CB, CR = 'y', 'cb', 'cr'
 
 
 def psnr(data1, data2, max_pixel=255):
-    mse = np.mean((data1 - data2) ** 2)
+    mse = np.mean(np.subtract(data1, data2, dtype=float) ** 2)
+    if mse:
+        return 20 * math.log10(max_pixel / mse ** 0.5)
+    return math.inf
+
+
+def estimate_psnr(coefficients, quantized, quality, max_pixel=255):
+    """Estimate the PSNR of extracted RGB (or grey level) pixels from the
+    quantization error of DCT coefficients without extracting.
+
+    As the 2D DCT is orthonormal, the squared error of coefficients equals to
+    the one of pixels in each layer. The errors of Y, Cb and Cr are weighted by
+    the YCbCr to RGB conversion assuming they are uncorrelated. The effects of
+    subsampling, padding and clipping are ignored.
+
+    Arguments:
+        coefficients {dict} -- Unquantized DCT blocks of each layer.
+        quantized {dict} -- Quantized and rounded blocks of each layer.
+        quality {int} -- The quality factor of quantization.
+
+    Keyword Arguments:
+        max_pixel {int} -- The maximum pixel value. (default: {255})
+
+    Returns:
+        float -- Estimated PSNR.
+    """
+
+    mse = sum(
+        YCBCR_ERROR_WEIGHTS[key] * np.mean(np.square(
+            coefficients[key]
+            - quantize(quantized[key], key, quality=quality, inverse=True)
+        ))
+        for key in coefficients
+    )
     if mse:
         return 20 * math.log10(max_pixel / mse ** 0.5)
     return math.inf
@@ -53,11 +87,10 @@ def rgb2ycbcr(r, g, b):  # pylint: disable=invalid-name
         OrderDict -- An ordered dictionary containing Y, Cb, Cr layers.
     """
 
-    return collections.OrderedDict((
-        (Y, + 0.299 * r + 0.587 * g + 0.114 * b),
-        (CB, - 0.168736 * r - 0.331264 * g + 0.5 * b),
-        (CR, + 0.5 * r - 0.418688 * g - 0.081312 * b)
-    ))
+    return collections.OrderedDict(
+        (key, r_coef * r + g_coef * g + b_coef * b)
+        for key, (r_coef, g_coef, b_coef) in RGB2YCBCR_COEFFICIENTS.items()
+    )
 
 
 def ycbcr2rgb(y, cb, cr):  # pylint: disable=invalid-name
@@ -82,13 +115,176 @@ def ycbcr2rgb(y, cb, cr):  # pylint: disable=invalid-name
     ))
 
 
-def downsample(arr, mode):
+def rgb2ycbcr_fixed(rgb):
+    """Convert interleaved RGB to YCbCr with fixed-point lookup tables.
+
+    The integer counterpart of `rgb2ycbcr` in the style of libjpeg. The range
+    of Y, Cb, Cr is [0, 255], [-128, 127], [-128, 127] respectively.
+
+    Arguments:
+        rgb {np.ndarray} -- Interleaved uint8 RGB array in the shape of
+            (..., 3).
+
+    Returns:
+        OrderDict -- An ordered dictionary containing integer Y, Cb, Cr layers.
+    """
+
+    return collections.OrderedDict(
+        (key, _rgb2layer(rgb, key, fixed_point=True)) for key in (Y, CB, CR)
+    )
+
+
+def rgb2ycbcr_downsample(rgb, mode, box_filter=False, fixed_point=False,
+                         dtype=float):
+    """Convert interleaved RGB to YCbCr and downsample Cb and Cr in one pass.
+
+    Only Y is computed in full resolution. Cb and Cr are computed at the
+    positions kept by `downsample`, or from the box-filtered RGB if
+    `box_filter` is set, which is equivalent as the conversion is linear.
+
+    Arguments:
+        rgb {np.ndarray} -- Interleaved RGB array in the shape of (..., 3).
+        mode {1 or 2 or 4} -- Downsample ratio (4:mode).
+
+    Keyword Arguments:
+        box_filter {bool} -- Average Cb and Cr over the subsampled area instead
+            of picking the top-left one. (default: {False})
+        fixed_point {bool} -- Use the fixed-point lookup tables of
+            `rgb2ycbcr_fixed`. (default: {False})
+        dtype {data-type} -- The float type of returned layers if not
+            `fixed_point`. (default: {float})
+
+    Returns:
+        OrderDict -- An ordered dictionary containing Y, Cb, Cr layers.
+    """
+
+    if fixed_point:
+        subsampled = downsample(rgb, mode, box_filter=box_filter)
+        if box_filter and mode != 4:
+            subsampled = np.rint(subsampled).astype(np.uint8)
+    else:
+        subsampled = downsample(rgb, mode, box_filter=box_filter, dtype=dtype)
+    return collections.OrderedDict((
+        (Y, _rgb2layer(rgb, Y, fixed_point=fixed_point, dtype=dtype)),
+        (CB, _rgb2layer(subsampled, CB, fixed_point=fixed_point, dtype=dtype)),
+        (CR, _rgb2layer(subsampled, CR, fixed_point=fixed_point, dtype=dtype))
+    ))
+
+
+def is_grey(rgb, tolerance=0):
+    """Check whether an RGB image is neutral (grey level).
+
+    Arguments:
+        rgb {np.ndarray} -- Interleaved RGB array in the shape of (..., 3).
+
+    Keyword Arguments:
+        tolerance {int} -- The largest difference between R, G and B of a
+            pixel to be neutral. (default: {0})
+
+    Returns:
+        bool -- Whether every pixel is neutral.
+    """
+    channels = rgb.reshape(-1, 3)
+    return bool((channels.max(axis=1) - channels.min(axis=1)).max()
+                <= tolerance)
+
+
+def _rgb2layer(rgb, key, fixed_point=False, dtype=float):
+    r, g, b = (rgb[..., idx] for idx in range(3))  # pylint: disable=invalid-name
+    if fixed_point:
+        r_table, g_table, b_table = RGB2YCBCR_TABLES[key]
+        return (r_table[r] + g_table[g] + b_table[b]) >> SCALEBITS
+    r_coef, g_coef, b_coef = (dtype(c) for c in RGB2YCBCR_COEFFICIENTS[key])
+    return r_coef * r + g_coef * g + b_coef * b
+
+
+def ycbcr2rgb_fixed(y, cb, cr):  # pylint: disable=invalid-name
+    """Convert YCbCr to interleaved RGB with fixed-point lookup tables.
+
+    The integer counterpart of `ycbcr2rgb` in the style of libjpeg. Y, Cb, Cr
+    should be uint8 arrays where Cb and Cr are offset by 128.
+
+    Arguments:
+        y {np.ndarray} -- Luminance Layer.
+        cb {np.ndarray} -- Chrominance (Cb) Layer.
+        cr {np.ndarray} -- Chrominance (Cr) Layer.
+
+    Returns:
+        np.ndarray -- Interleaved uint8 RGB array in the shape of (..., 3).
+    """
+
+    return ycbcr2rgb_upsample(y, cb, cr, 4, fixed_point=True)
+
+
+def ycbcr2rgb_upsample(y, cb, cr, mode, fixed_point=False):  # pylint: disable=invalid-name, too-many-locals
+    """Upsample Cb and Cr, convert YCbCr to RGB, then round, clip and
+    interleave in one pass.
+
+    The chrominance terms are computed at the subsampled resolution and added
+    to each phase of Y, so the upsampled Cb and Cr are never materialized.
+
+    Arguments:
+        y {np.ndarray} -- Luminance Layer.
+        cb {np.ndarray} -- Subsampled Chrominance (Cb) Layer.
+        cr {np.ndarray} -- Subsampled Chrominance (Cr) Layer.
+        mode {1 or 2 or 4} -- Upsample ratio (4:mode).
+
+    Keyword Arguments:
+        fixed_point {bool} -- Use the fixed-point lookup tables of
+            `ycbcr2rgb_fixed`. Y, Cb, Cr should be uint8 arrays where Cb and Cr
+            are offset by 128. (default: {False})
+
+    Returns:
+        np.ndarray -- Interleaved uint8 RGB array in the shape of (..., 3).
+    """
+    if mode not in {1, 2, 4}:
+        raise ValueError(f'Mode ({mode}) must be 1, 2 or 4.')
+
+    nrows, ncols = (1, 1) if mode == 4 else (3 - mode, 2)
+    if fixed_point:
+        terms = (
+            (CR_R_TABLE[cr], ),
+            ((CB_G_TABLE[cb] + CR_G_TABLE[cr]) >> SCALEBITS, ),
+            (CB_B_TABLE[cb], )
+        )
+    else:
+        # Keep the operation order of `ycbcr2rgb`.
+        terms = (
+            (1.402 * cr, ),
+            (-0.344136 * cb, -0.714136 * cr),
+            (1.772 * cb, )
+        )
+
+    ret = np.empty((*y.shape, 3), dtype=np.uint8)
+    for i, j in itertools.product(range(nrows), range(ncols)):
+        luma = y[i::nrows, j::ncols]
+        if fixed_point:
+            luma = luma.astype(np.int32)
+        crop = (slice(luma.shape[0]), slice(luma.shape[1]))
+        for channel, channel_terms in enumerate(terms):
+            value = luma
+            for term in channel_terms:
+                value = value + term[crop]
+            if not fixed_point:
+                value = np.rint(value)
+            ret[i::nrows, j::ncols, channel] = np.clip(value, 0, 255)
+    return ret
+
+
+def downsample(arr, mode, box_filter=False, dtype=float):
     """Downsample an 2D array.
 
     Arguments:
-        arr {2d numpy array} -- The target array.
+        arr {2d numpy array} -- The target array. Extra trailing dimensions
+            (e.g. interleaved channels) are kept.
         mode {1 or 2 or 4} -- Downsample ratio (4:mode).
 
+    Keyword Arguments:
+        box_filter {bool} -- Average the subsampled area instead of picking the
+            top-left element. (default: {False})
+        dtype {data-type} -- The float type of the averages if `box_filter`.
+            (default: {float})
+
     Returns:
         2d numpy array -- Downsampled array.
     """
@@ -97,7 +293,19 @@ def downsample(arr, mode):
 
     if mode == 4:
         return arr
-    return arr[::3 - mode, ::2]
+    if not box_filter:
+        return arr[::3 - mode, ::2]
+
+    nrows, ncols = 3 - mode, 2
+    shape = (-(-arr.shape[0] // nrows), -(-arr.shape[1] // ncols))
+    total = np.zeros(shape + arr.shape[2:], dtype=dtype)
+    count = np.zeros(shape + (1, ) * (arr.ndim - 2), dtype=dtype)
+    for i, j in itertools.product(range(nrows), range(ncols)):
+        part = arr[i::nrows, j::ncols]
+        total[:part.shape[0], :part.shape[1]] += part
+        count[:part.shape[0], :part.shape[1]] += 1
+    total /= count
+    return total
 
 
 def upsample(arr, mode):
@@ -161,23 +369,217 @@ def block_combine(arr, nrows, ncols):
             .reshape(nrows, ncols))
 
 
+def block_view(arr, nrows, ncols):
+    """Return a writable view of the blocks fully inside a 2D array in the shape
+    (h // nrows, w // ncols, nrows, ncols).
+
+    The remaining rows and columns which cannot fill a block are left out.
+    """
+    h, w = arr.shape  # pylint: disable=invalid-name
+    return (arr[:h - h % nrows, :w - w % ncols]
+            .reshape(h // nrows, nrows, w // ncols, ncols)
+            .swapaxes(1, 2))
+
+
+def pad_block_slice(arr, nrows, ncols, dtype=float):
+    """Pad a 2D array with zeros to the multiple of the block size and slice it
+    into blocks in a single copy.
+
+    Arguments:
+        arr {2D np.array} -- The target array.
+        nrows {int} -- The row size of a block.
+        ncols {int} -- The column size of a block.
+
+    Keyword Arguments:
+        dtype {data-type} -- The data type of returned blocks. (default: {float})
+
+    Returns:
+        3D np.array -- A list of blocks in the same order as `block_slice`.
+    """
+    h, w = arr.shape  # pylint: disable=invalid-name
+    ret = np.zeros((-(-h // nrows) * -(-w // ncols), nrows, ncols), dtype=dtype)
+    _copy_blocks(
+        arr,
+        ret.reshape((-(-h // nrows), -(-w // ncols), nrows, ncols)),
+        to_blocks=True
+    )
+    return ret
+
+
+def crop_block_combine(arr, nrows, ncols):
+    """Combine a list of blocks into nrows * ncols 2D matrix, dropping the
+    padding out of it, in a single copy.
+
+    Arguments:
+        arr {3D np.array} -- A list of blocks in the format:
+            arr[# of block][block row size][block column size]
+        nrows {int} -- The target row size after combination.
+        ncols {int} -- The target column size after combination.
+
+    Returns:
+        2D np.array -- Combined matrix.
+
+    Raise:
+        ValueError -- The number of blocks does not cover `nrows * ncols`
+            exactly.
+    """
+    _, block_nrows, block_ncols = arr.shape
+    grid = (-(-nrows // block_nrows), -(-ncols // block_ncols))
+    if len(arr) != grid[0] * grid[1]:
+        raise ValueError(f'The number of blocks ({len(arr)}) does not fit '
+                         f'nrows * ncols ({nrows} * {ncols}).')
+    ret = np.empty((nrows, ncols), dtype=arr.dtype)
+    _copy_blocks(ret, arr.reshape(*grid, block_nrows, block_ncols),
+                 to_blocks=False)
+    return ret
+
+
+def _copy_blocks(arr, grid, to_blocks):
+    """Copy between a 2D array and a 4D grid of blocks. The blocks on the
+    bottom and right edges are copied through their partial areas."""
+    h, w = arr.shape  # pylint: disable=invalid-name
+    nrows, ncols = grid.shape[2:]
+    full_h, full_w = h - h % nrows, w - w % ncols
+    pairs = [(block_view(arr, nrows, ncols), grid[:h // nrows, :w // ncols])]
+    if w % ncols:  # Right edge
+        pairs.append((
+            arr[:full_h, full_w:].reshape(h // nrows, nrows, w % ncols),
+            grid[:h // nrows, -1, :, :w % ncols]
+        ))
+    if h % nrows:  # Bottom edge
+        pairs.append((
+            arr[full_h:, :full_w].reshape(h % nrows, w // ncols, ncols)
+            .swapaxes(0, 1),
+            grid[-1, :w // ncols, :h % nrows]
+        ))
+    if h % nrows and w % ncols:  # Bottom right corner
+        pairs.append((arr[full_h:, full_w:],
+                      grid[-1, -1, :h % nrows, :w % ncols]))
+    for image, blocks in pairs:
+        if to_blocks:
+            blocks[...] = image
+        else:
+            image[...] = blocks
+
+
+def flat_blocks(arr):
+    """Find the blocks whose elements are all the same value.
+
+    Arguments:
+        arr {3D np.array} -- A list of blocks in the format:
+            arr[# of block][block row size][block column size]
+
+    Returns:
+        1D np.array -- A boolean mask which is `True` for flat blocks.
+    """
+    return (arr == arr[:, :1, :1]).all(axis=(1, 2))
+
+
 def dct2d(arr):
-    return dct(dct(arr, norm='ortho', axis=0), norm='ortho', axis=1)
+    """2D DCT over the last two axes, so a stack of blocks can be
+    transformed at once."""
+    return dct(dct(arr, norm='ortho', axis=-2), norm='ortho', axis=-1)
 
 
 def idct2d(arr):
-    return idct(idct(arr, norm='ortho', axis=0), norm='ortho', axis=1)
+    """2D IDCT over the last two axes."""
+    return idct(idct(arr, norm='ortho', axis=-2), norm='ortho', axis=-1)
+
+
+def quantize(block, block_type, quality=50, inverse=False, transposed=False):
+    # Keep float32 (or smaller) blocks in float32.
+    table = scaled_quantization_table(block_type, quality, transposed).astype(
+        np.result_type(np.asarray(block).dtype, np.float32), copy=False
+    )
+    if inverse:
+        return block * table
+    return block / table
 
 
-def quantize(block, block_type, quality=50, inverse=False):
+def scaled_quantization_table(block_type, quality=50, transposed=False):
+    """Return the quantization table of the layer scaled by quality factor.
+    Transposed images use the transposed table."""
     if block_type == Y:
         quantization_table = LUMINANCE_QUANTIZATION_TABLE
     else:  # Cb or Cr (LUMINANCE)
         quantization_table = CHROMINANCE_QUANTIZATION_TABLE
+    if transposed:
+        quantization_table = quantization_table.T
     factor = 5000 / quality if quality < 50 else 200 - 2 * quality
-    if inverse:
-        return block * (quantization_table * factor / 100)
-    return block / (quantization_table * factor / 100)
+    return quantization_table * factor / 100
+
+
+def reorient_blocks(arr, nrows, ncols, operation):
+    """Rotate, flip or transpose an image sliced into 8x8 DCT blocks without
+    inverse DCT. The blocks are permuted and their coefficients are transposed
+    or sign-flipped, where mirroring an 8-point DCT negates its odd
+    frequencies.
+
+    Arguments:
+        arr {3D np.array} -- A list of DCT blocks of the image.
+        nrows {int} -- The row size of the image, a multiple of 8.
+        ncols {int} -- The column size of the image, a multiple of 8.
+        operation {str} -- One of the keys of `ORIENTATIONS`.
+
+    Returns:
+        3D np.array -- A list of the reoriented DCT blocks.
+    """
+    grid = arr.reshape(nrows // 8, ncols // 8, 8, 8)
+    for step in ORIENTATIONS[operation]:
+        if step == 'transpose':
+            grid = grid.transpose(1, 0, 3, 2)
+        elif step == 'flip_horizontal':
+            grid = grid[:, ::-1] * ODD_FREQUENCY_SIGNS
+        else:  # flip_vertical
+            grid = grid[::-1] * ODD_FREQUENCY_SIGNS[:, None]
+    return grid.reshape(-1, 8, 8)
+
+
+def downscale_blocks(arr, nrows, ncols):
+    """Downscale an image sliced into 8x8 DCT blocks by 2 without inverse DCT.
+    Each output block averages the 2x2 pixels of a 2x2 group of input blocks,
+    which is the sum of the input blocks multiplied by `DOWNSCALE_MATRICES` on
+    both sides.
+
+    Arguments:
+        arr {3D np.array} -- A list of DCT blocks of the image.
+        nrows {int} -- The number of block rows of the image, a multiple of 2.
+        ncols {int} -- The number of block columns of the image, a multiple of
+            2.
+
+    Returns:
+        3D np.array -- A list of the downscaled DCT blocks.
+    """
+    grid = arr.reshape((nrows // 2, 2, ncols // 2, 2, 8, 8))
+    return np.einsum('ieb,micjbd,jgd->mceg', DOWNSCALE_MATRICES, grid,
+                     DOWNSCALE_MATRICES, optimize=True).reshape(-1, 8, 8)
+
+
+# The orthonormal DCT matrix, where `dct2d(arr)` is `D @ arr @ D.T`.
+DCT_MATRIX = dct(np.eye(8), norm='ortho', axis=0)
+
+# The 2x downscaling in DCT domain of the first and second half of 16 pixels,
+# which is `D @ A @ D.T` where `A` averages each 2 adjacent pixels of the half
+# into one of 8 output pixels.
+DOWNSCALE_MATRICES = np.array([
+    DCT_MATRIX @ (np.kron(np.eye(8), (.5, .5))[:, half * 8:half * 8 + 8])
+    @ DCT_MATRIX.T
+    for half in range(2)
+])
+
+# The steps of each operation, where a rotation is a transposition followed by
+# flips.
+ORIENTATIONS = {
+    'flip_horizontal': ('flip_horizontal',),
+    'flip_vertical': ('flip_vertical',),
+    'transpose': ('transpose',),
+    'transverse': ('transpose', 'flip_horizontal', 'flip_vertical'),
+    'rotate_90': ('transpose', 'flip_horizontal'),
+    'rotate_180': ('flip_horizontal', 'flip_vertical'),
+    'rotate_270': ('transpose', 'flip_vertical')
+}
+
+ODD_FREQUENCY_SIGNS = np.array((1, -1, 1, -1, 1, -1, 1, -1))
 
 
 LUMINANCE_QUANTIZATION_TABLE = np.array((
@@ -201,3 +603,53 @@ CHROMINANCE_QUANTIZATION_TABLE = np.array((
     (99, 99, 99, 99, 99, 99, 99, 99),
     (99, 99, 99, 99, 99, 99, 99, 99)
 ))
+
+RGB2YCBCR_COEFFICIENTS = collections.OrderedDict((
+    (Y, (0.299, 0.587, 0.114)),
+    (CB, (-0.168736, -0.331264, 0.5)),
+    (CR, (0.5, -0.418688, -0.081312))
+))
+
+# The mean of the squared YCbCr to RGB conversion coefficients of each layer,
+# which maps a squared error of the layer to the one of RGB pixels.
+YCBCR_ERROR_WEIGHTS = {
+    Y: 1,
+    CB: (0.344136 ** 2 + 1.772 ** 2) / 3,
+    CR: (1.402 ** 2 + 0.714136 ** 2) / 3
+}
+
+SCALEBITS = 16
+
+
+def _fix(value):
+    return int(value * (1 << SCALEBITS) + 0.5)
+
+
+def _fixed_table(coefficient, offset=0, shift=False):
+    """Return the lookup table of `coefficient * value` for all uint8 values in
+    fixed-point. `offset` is added before the optional right shift. Negative
+    coefficients are negated after rounding, as libjpeg does."""
+    fixed = _fix(coefficient) if coefficient >= 0 else -_fix(-coefficient)
+    table = (fixed * np.arange(256, dtype=np.int64) + offset).astype(np.int32)
+    return table >> SCALEBITS if shift else table
+
+
+# The rounding constant is folded into the blue tables, and the Cb one is
+# decreased by one to keep 0.5 * 255 in [-128, 127].
+RGB2YCBCR_TABLES = collections.OrderedDict((
+    (Y, (_fixed_table(0.299), _fixed_table(0.587),
+         _fixed_table(0.114, 1 << (SCALEBITS - 1)))),
+    (CB, (_fixed_table(-0.168736), _fixed_table(-0.331264),
+          _fixed_table(0.5, (1 << (SCALEBITS - 1)) - 1))),
+    (CR, (_fixed_table(0.5), _fixed_table(-0.418688),
+          _fixed_table(-0.081312, 1 << (SCALEBITS - 1))))
+))
+
+# Cb and Cr are offset by 128 as the table index.
+CR_R_TABLE = _fixed_table(1.402, (1 << (SCALEBITS - 1)) - _fix(1.402) * 128,
+                          shift=True)
+CB_B_TABLE = _fixed_table(1.772, (1 << (SCALEBITS - 1)) - _fix(1.772) * 128,
+                          shift=True)
+CR_G_TABLE = _fixed_table(-0.714136, _fix(0.714136) * 128)
+CB_G_TABLE = _fixed_table(-0.344136, _fix(0.344136) * 128
+                          + (1 << (SCALEBITS - 1)))
@@ -1,7 +1,18 @@
+import os
 import tempfile
 import unittest
 
-from prototype_jpeg import __version__, compress, extract
+import numpy as np
+
+from prototype_jpeg import (__version__, analyze, compress, compress_ladder,
+                            extract)
+from prototype_jpeg.batch import (compress_batch, compress_many, extract_many,
+                                  repack_directory)
+from prototype_jpeg.codec import DC, AC, EOB, LUMINANCE, CHROMINANCE
+from prototype_jpeg.transcode import (compress_coefficients, crop, downscale,
+                                      extract_coefficients, reorient, repack,
+                                      requantize, stitch)
+from prototype_jpeg.utils import psnr, ycbcr2rgb_upsample, Y, CB, CR
 
 
 def test_version():
@@ -89,6 +100,600 @@ class TestCompressAndExtract(unittest.TestCase):
             'subsampling_mode': 4
         })
 
+    def test_rgb_fixed_point(self):
+        for fn in ('tests/images/rgb/Baboon.raw', 'tests/images/rgb/Lena.raw'):
+            spec = {
+                'fn': fn,
+                'size': (512, 512),
+                'grey_level': False,
+                'quality': 50,
+                'subsampling_mode': 1
+            }
+            reference = compress_and_extract(spec)
+            extracted = compress_and_extract({**spec, 'fixed_point': True})
+            self.assertGreater(psnr(reference, extracted), 40)
+
+    def test_rgb_box_filter(self):
+        for mode in (1, 2):
+            with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+                original = np.fromfile(raw_file, dtype=np.uint8)
+            extracted = compress_and_extract({
+                'fn': 'tests/images/rgb/Lena.raw',
+                'size': (512, 512),
+                'grey_level': False,
+                'quality': 50,
+                'subsampling_mode': mode,
+                'box_filter': True
+            })
+            self.assertGreater(psnr(original, extracted), 25)
+
+    def test_rgb_unaligned_size(self):
+        with open('tests/images/rgb/Baboon.raw', 'rb') as raw_file:
+            baboon = np.fromfile(raw_file, dtype=np.uint8).reshape(512, 512, 3)
+        original = np.ascontiguousarray(baboon[:101, :77])
+        for mode in (1, 2, 4):
+            with tempfile.NamedTemporaryFile() as raw_file:
+                original.tofile(raw_file)
+                raw_file.flush()
+                extracted = compress_and_extract({
+                    'fn': raw_file.name,
+                    'size': (101, 77),
+                    'grey_level': False,
+                    'quality': 90,
+                    'subsampling_mode': mode
+                })
+            self.assertGreater(psnr(original.flatten(), extracted), 20)
+
+    def test_compact(self):
+        for fn, grey_level in (('tests/images/rgb/Lena.raw', False),
+                               ('tests/images/grey_level/Lena.raw', True)):
+            spec = {
+                'fn': fn,
+                'size': (512, 512),
+                'grey_level': grey_level,
+                'quality': 50,
+                'subsampling_mode': 1
+            }
+            reference = compress_and_extract(spec)
+            extracted = compress_and_extract({**spec, 'compact': True})
+            self.assertEqual(extracted.dtype, np.uint8)
+            self.assertGreater(psnr(reference, extracted), 35)
+
+    def test_target_bytes(self):
+        for fn, grey_level in (('tests/images/rgb/Lena.raw', False),
+                               ('tests/images/grey_level/Baboon.raw', True)):
+            with open(fn, 'rb') as raw_file:
+                compressed = compress(raw_file, size=(512, 512),
+                                      grey_level=grey_level,
+                                      target_bytes=20000)
+            quality = compressed['header']['quality']
+            self.assertLessEqual(len(compressed['data'].tobytes()), 20000)
+            with open(fn, 'rb') as raw_file:
+                higher = compress(raw_file, size=(512, 512),
+                                  grey_level=grey_level, quality=quality + 1)
+            self.assertGreater(len(higher['data'].tobytes()), 20000)
+
+    def test_target_bytes_too_small(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            with self.assertRaises(ValueError):
+                compress(raw_file, size=(512, 512), target_bytes=100)
+
+    def test_estimate_psnr(self):
+        with open('tests/images/grey_level/Lena.raw', 'rb') as raw_file:
+            original = np.fromfile(raw_file, dtype=np.uint8)
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(512, 512), grey_level=True,
+                                  estimate_psnr=True)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            extracted = extract(compressed_file, compressed['header'])
+        self.assertAlmostEqual(compressed['psnr'], psnr(original, extracted),
+                               delta=0.5)
+
+    def test_target_psnr(self):
+        with open('tests/images/rgb/Baboon.raw', 'rb') as raw_file:
+            compressed = compress(raw_file, size=(512, 512), target_psnr=24)
+            raw_file.seek(0)
+            lower = compress(raw_file, size=(512, 512),
+                             quality=compressed['header']['quality'] - 1,
+                             estimate_psnr=True)
+        self.assertGreaterEqual(compressed['psnr'], 24)
+        self.assertLess(lower['psnr'], 24)
+
+    def test_target_psnr_unreachable(self):
+        with open('tests/images/rgb/Baboon.raw', 'rb') as raw_file:
+            with self.assertRaises(ValueError):
+                compress(raw_file, size=(512, 512), target_psnr=99)
+
+    def test_compress_ladder(self):
+        for max_workers in (1, 2):
+            with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+                ladder = compress_ladder(raw_file, size=(512, 512),
+                                         qualities=(80, 20),
+                                         max_workers=max_workers)
+            for quality, compressed in zip((80, 20), ladder):
+                with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+                    expect = compress(raw_file, size=(512, 512),
+                                      quality=quality)
+                self.assertEqual(compressed['data'], expect['data'])
+                self.assertDictEqual(compressed['header'], expect['header'])
+
+    def test_rdo(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            original = np.fromfile(raw_file, dtype=np.uint8)
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(512, 512), quality=50)
+            raw_file.seek(0)
+            optimized = compress(raw_file, size=(512, 512), quality=50,
+                                 rdo=True)
+        self.assertLess(len(optimized['data']), len(compressed['data']))
+        self.assertGreaterEqual(optimized['rdo_time'], 0)
+        extracted = compress_and_extract({
+            'fn': 'tests/images/rgb/Lena.raw',
+            'size': (512, 512),
+            'grey_level': False,
+            'quality': 50,
+            'subsampling_mode': 1,
+            'rdo': True
+        })
+        self.assertGreater(psnr(original, extracted), 30)
+
+    def test_requantize(self):
+        for fn, grey_level in (('tests/images/rgb/Lena.raw', False),
+                               ('tests/images/grey_level/Lena.raw', True)):
+            with open(fn, 'rb') as raw_file:
+                original = np.fromfile(raw_file, dtype=np.uint8)
+                raw_file.seek(0)
+                compressed = compress(raw_file, size=(512, 512), quality=90,
+                                      grey_level=grey_level)
+            with tempfile.TemporaryFile() as compressed_file:
+                compressed['data'].tofile(compressed_file)
+                compressed_file.seek(0)
+                same = requantize(compressed_file, compressed['header'], 90)
+                compressed_file.seek(0)
+                requantized = requantize(compressed_file,
+                                         compressed['header'], 30)
+            self.assertEqual(same['data'], compressed['data'])
+            self.assertEqual(requantized['header']['quality'], 30)
+            self.assertLess(len(requantized['data']), len(compressed['data']))
+            with tempfile.TemporaryFile() as compressed_file:
+                requantized['data'].tofile(compressed_file)
+                compressed_file.seek(0)
+                extracted = extract(compressed_file, requantized['header'])
+            self.assertGreater(psnr(original, extracted), 28)
+
+    def test_reorient(self):
+        expects = {
+            'flip_horizontal': lambda image: image[:, ::-1],
+            'flip_vertical': lambda image: image[::-1],
+            'transpose': lambda image: image.swapaxes(0, 1),
+            'transverse': lambda image: image.swapaxes(0, 1)[::-1, ::-1],
+            'rotate_90': lambda image: np.rot90(image, -1),
+            'rotate_180': lambda image: np.rot90(image, 2),
+            'rotate_270': lambda image: np.rot90(image, 1)
+        }
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            original = np.ascontiguousarray(np.fromfile(
+                raw_file, dtype=np.uint8
+            ).reshape(512, 512, 3)[:128, :64])
+        with tempfile.NamedTemporaryFile() as raw_file:
+            original.tofile(raw_file)
+            raw_file.flush()
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(128, 64), quality=50)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            extracted = extract(compressed_file, compressed['header']).reshape(
+                128, 64, 3
+            )
+            for operation, expect in expects.items():
+                compressed_file.seek(0)
+                reoriented = reorient(compressed_file, compressed['header'],
+                                      operation)
+                with tempfile.TemporaryFile() as reoriented_file:
+                    reoriented['data'].tofile(reoriented_file)
+                    reoriented_file.seek(0)
+                    np.testing.assert_array_equal(
+                        extract(reoriented_file, reoriented['header']),
+                        expect(extracted).ravel()
+                    )
+            with self.assertRaises(ValueError):
+                reorient(compressed_file, compressed['header'], 'rotate_45')
+            with self.assertRaises(ValueError):
+                reorient(compressed_file,
+                         {**compressed['header'], 'size': (120, 64)},
+                         'flip_vertical')
+
+    def test_crop_and_stitch(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            original = np.ascontiguousarray(np.fromfile(
+                raw_file, dtype=np.uint8
+            ).reshape(512, 512, 3)[:101, :77])
+        with tempfile.NamedTemporaryFile() as raw_file:
+            original.tofile(raw_file)
+            raw_file.flush()
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(101, 77), quality=50)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            extracted = extract(compressed_file, compressed['header']).reshape(
+                101, 77, 3
+            )
+            parts = []
+            for top, left, height, width in ((0, 0, 32, 48), (0, 48, 32, 29),
+                                             (32, 0, 69, 48),
+                                             (32, 48, 69, 29)):
+                compressed_file.seek(0)
+                parts.append(crop(compressed_file, compressed['header'],
+                                  (top, left, height, width)))
+                self.assertSequenceEqual(parts[-1]['header']['size'],
+                                         (height, width))
+                with tempfile.TemporaryFile() as cropped_file:
+                    parts[-1]['data'].tofile(cropped_file)
+                    cropped_file.seek(0)
+                    np.testing.assert_array_equal(
+                        extract(cropped_file, parts[-1]['header']),
+                        extracted[top:top + height, left:left + width].ravel()
+                    )
+            with self.assertRaises(ValueError):
+                crop(compressed_file, compressed['header'], (8, 0, 16, 16))
+
+        part_files = [tempfile.TemporaryFile() for _ in parts]
+        for part, part_file in zip(parts, part_files):
+            part['data'].tofile(part_file)
+            part_file.seek(0)
+        stitched = stitch([(part_file, part['header'])
+                           for part, part_file in zip(parts, part_files)],
+                          (2, 2))
+        for part_file in part_files:
+            part_file.close()
+        self.assertEqual(stitched['data'], compressed['data'])
+        self.assertDictEqual(stitched['header'], compressed['header'])
+        with self.assertRaises(ValueError):
+            stitch([(None, part['header']) for part in parts], (1, 4))
+
+    def test_downscale(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            original = np.fromfile(raw_file, dtype=np.uint8).reshape(512, 512, 3)
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(512, 512), quality=75)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            downscaled = downscale(compressed_file, compressed['header'])
+        self.assertSequenceEqual(downscaled['header']['size'], (256, 256))
+        self.assertEqual(downscaled['header']['quality'], 75)
+        with tempfile.TemporaryFile() as downscaled_file:
+            downscaled['data'].tofile(downscaled_file)
+            downscaled_file.seek(0)
+            extracted = extract(downscaled_file, downscaled['header'])
+        self.assertGreater(
+            psnr(original.reshape(256, 2, 256, 2, 3).mean(axis=(1, 3)).ravel(),
+                 extracted),
+            30
+        )
+
+    def test_repack(self):
+        for fn, grey_level in (('tests/images/rgb/Lena.raw', False),
+                               ('tests/images/grey_level/Lena.raw', True)):
+            with open(fn, 'rb') as raw_file:
+                compressed = compress(raw_file, size=(512, 512), quality=30,
+                                      grey_level=grey_level)
+            with tempfile.TemporaryFile() as compressed_file:
+                compressed['data'].tofile(compressed_file)
+                compressed_file.seek(0)
+                extracted = extract(compressed_file, compressed['header'])
+                compressed_file.seek(0)
+                repacked = repack(compressed_file, compressed['header'])
+            self.assertLess(len(repacked['data']), len(compressed['data']))
+            self.assertIn('huffman_tables', repacked['header'])
+            with tempfile.TemporaryFile() as repacked_file:
+                repacked['data'].tofile(repacked_file)
+                repacked_file.seek(0)
+                np.testing.assert_array_equal(
+                    extract(repacked_file, repacked['header']),
+                    extracted
+                )
+
+    def test_repack_directory(self):
+        headers = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for fn in ('Baboon', 'Lena'):
+                with open(f'tests/images/grey_level/{fn}.raw', 'rb') as raw_file:
+                    compressed = compress(raw_file, size=(512, 512),
+                                          quality=20, grey_level=True)
+                with open(os.path.join(directory, fn), 'wb') as compressed_file:
+                    compressed['data'].tofile(compressed_file)
+                headers[fn] = compressed['header']
+            output_directory = os.path.join(directory, 'repacked')
+            repacked_headers = repack_directory(directory, headers,
+                                                output_directory, max_workers=2)
+            self.assertCountEqual(repacked_headers, headers)
+            for fn, header in repacked_headers.items():
+                self.assertLess(
+                    os.path.getsize(os.path.join(output_directory, fn)),
+                    os.path.getsize(os.path.join(directory, fn))
+                )
+                self.assertIn('huffman_tables', header)
+
+    def test_compress_many_and_extract_many(self):
+        with tempfile.TemporaryDirectory() as directory:
+            specs = [{
+                'fn': 'tests/images/grey_level/Lena.raw',
+                'size': (512, 512),
+                'grey_level': True,
+                'quality': 50,
+                'output': os.path.join(directory, 'grey')
+            }, {
+                'fn': 'tests/images/rgb/Baboon.raw',
+                'size': (512, 512),
+                'quality': 30,
+                'subsampling_mode': 2,
+                'output': os.path.join(directory, 'rgb')
+            }]
+            results = []
+            stats = compress_many(
+                specs, max_workers=1,
+                callback=lambda spec, result: results.append((spec, result))
+            )
+            # The largest file is scheduled first.
+            self.assertListEqual([spec for spec, _ in results], specs[::-1])
+            self.assertEqual(stats['files'], 2)
+            self.assertEqual(stats['pixels'], 2 * 512 * 512)
+            self.assertEqual(stats['input_bytes'], 4 * 512 * 512)
+            self.assertEqual(stats['output_bytes'], sum(
+                os.path.getsize(spec['output']) for spec in specs
+            ))
+            # Specs with an output path write their data to it even if the
+            # results are passed through shared memory.
+            shared = []
+            compress_many(
+                specs, max_workers=1, shared=True,
+                callback=lambda spec, result: shared.append((spec, result))
+            )
+            for (_, result), (_, expected) in zip(shared, results):
+                self.assertNotIn('data', result)
+                self.assertEqual(result['header'], expected['header'])
+
+            extracted = []
+            stats = extract_many(
+                [{'fn': spec['output'], 'header': result['header']}
+                 for spec, result in results],
+                max_workers=2,
+                callback=lambda spec, raw: extracted.append((spec, raw))
+            )
+            self.assertEqual(stats['output_bytes'], 4 * 512 * 512)
+            for spec, raw in extracted:
+                with open(spec['fn'], 'rb') as compressed_file:
+                    np.testing.assert_array_equal(
+                        raw, extract(compressed_file, spec['header'])
+                    )
+
+            # Results passed back through shared memory are the same.
+            shared = []
+            compress_many(
+                [{key: value for key, value in spec.items() if key != 'output'}
+                 for spec in specs],
+                max_workers=2, shared=True,
+                callback=lambda spec, result: shared.append((spec, result))
+            )
+            for spec, result in shared:
+                with open(spec['fn'], 'rb') as raw_file:
+                    expected = compress(raw_file, **{
+                        key: value for key, value in spec.items()
+                        if key != 'fn'
+                    })
+                self.assertEqual(result['data'], expected['data'])
+                self.assertEqual(result['header'], expected['header'])
+            for planar in (False, True):
+                shared = []
+                extract_many(
+                    [dict(spec, planar=planar) for spec, _ in extracted],
+                    max_workers=2, shared=True,
+                    callback=lambda spec, raw: shared.append((spec, raw))
+                )
+                for spec, raw in shared:
+                    with open(spec['fn'], 'rb') as compressed_file:
+                        expected = extract(compressed_file, spec['header'],
+                                           planar=planar)
+                    if planar:
+                        self.assertCountEqual(raw, expected)
+                        for key, plane in expected.items():
+                            np.testing.assert_array_equal(raw[key], plane)
+                    else:
+                        np.testing.assert_array_equal(raw, expected)
+
+    def test_coefficients(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            compressed = compress(raw_file, size=(512, 512), quality=30)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            extracted = extract_coefficients(compressed_file,
+                                             compressed['header'])
+        for key, shape in ((Y, (4096, 8, 8)), (CB, (1024, 8, 8)),
+                           (CR, (1024, 8, 8))):
+            self.assertEqual(extracted['coefficients'][key].shape, shape)
+            self.assertEqual(extracted['coefficients'][key].dtype, np.int16)
+            self.assertEqual(extracted['quantization_tables'][key].shape,
+                             (8, 8))
+        recompressed = compress_coefficients(extracted['coefficients'],
+                                             size=(512, 512), quality=30)
+        self.assertEqual(recompressed['data'], compressed['data'])
+        self.assertDictEqual(recompressed['header'], compressed['header'])
+        with self.assertRaises(ValueError):
+            compress_coefficients(extracted['coefficients'], size=(256, 512))
+
+    def test_luma_only(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            compressed = compress(raw_file, size=(512, 512), quality=50)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            luma = extract(compressed_file, compressed['header'],
+                           luma_only=True)
+            compressed_file.seek(0)
+            coefficients = extract_coefficients(compressed_file,
+                                                compressed['header'])
+        with tempfile.TemporaryFile() as grey_file:
+            grey = compress_coefficients(
+                {Y: coefficients['coefficients'][Y]},
+                size=(512, 512),
+                quality=50,
+                grey_level=True
+            )
+            grey['data'].tofile(grey_file)
+            grey_file.seek(0)
+            np.testing.assert_array_equal(
+                luma,
+                extract(grey_file, grey['header'])
+            )
+
+    def test_planar(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            compressed = compress(raw_file, size=(512, 512), quality=50)
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            planes = extract(compressed_file, compressed['header'],
+                             planar=True)
+            compressed_file.seek(0)
+            extracted = extract(compressed_file, compressed['header'],
+                                fixed_point=True)
+        self.assertEqual(planes[Y].shape, (512, 512))
+        self.assertEqual(planes[CB].shape, (256, 256))
+        self.assertEqual(planes[CR].dtype, np.uint8)
+        np.testing.assert_array_equal(
+            ycbcr2rgb_upsample(planes[Y], planes[CB], planes[CR], 1,
+                               fixed_point=True).ravel(),
+            extracted
+        )
+
+    def test_detect_grey(self):
+        with open('tests/images/grey_level/Lena.raw', 'rb') as raw_file:
+            grey = np.fromfile(raw_file, dtype=np.uint8)
+            raw_file.seek(0)
+            expect = compress(raw_file, size=(512, 512), grey_level=True)
+        with tempfile.NamedTemporaryFile() as raw_file:
+            np.repeat(grey, 3).tofile(raw_file)
+            raw_file.flush()
+            raw_file.seek(0)
+            compressed = compress(raw_file, size=(512, 512), detect_grey=True)
+        self.assertEqual(compressed['data'], expect['data'])
+        self.assertTrue(compressed['header']['grey_level'])
+        self.assertTrue(compressed['header']['expand_to_rgb'])
+        with tempfile.TemporaryFile() as compressed_file:
+            compressed['data'].tofile(compressed_file)
+            compressed_file.seek(0)
+            extracted = extract(compressed_file, compressed['header'])
+        self.assertEqual(extracted.shape, (512 * 512 * 3,))
+        self.assertGreater(psnr(np.repeat(grey, 3), extracted), 30)
+
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            compressed = compress(raw_file, size=(512, 512), detect_grey=True,
+                                  grey_tolerance=8)
+        self.assertFalse(compressed['header']['grey_level'])
+
+    def test_mcu_rows(self):
+        with open('tests/images/rgb/Baboon.raw', 'rb') as raw_file:
+            baboon = np.fromfile(raw_file, dtype=np.uint8).reshape(512, 512, 3)
+        original = np.ascontiguousarray(baboon[:101, :77])
+        for mode in (1, 2, 4):
+            with tempfile.NamedTemporaryFile() as raw_file:
+                original.tofile(raw_file)
+                raw_file.flush()
+                raw_file.seek(0)
+                compressed = compress(raw_file, size=(101, 77),
+                                      subsampling_mode=mode)
+                raw_file.seek(0)
+                stripped = compress(raw_file, size=(101, 77),
+                                    subsampling_mode=mode, mcu_rows=2)
+            self.assertEqual(stripped['data'], compressed['data'])
+            with tempfile.TemporaryFile() as compressed_file:
+                compressed['data'].tofile(compressed_file)
+                compressed_file.seek(0)
+                extracted = extract(compressed_file, compressed['header'])
+                compressed_file.seek(0)
+                np.testing.assert_array_equal(
+                    extract(compressed_file, compressed['header'], mcu_rows=1),
+                    extracted
+                )
+
+    def test_compress_batch(self):
+        images = []
+        for fn in ('tests/images/rgb/Baboon.raw', 'tests/images/rgb/Lena.raw'):
+            with open(fn, 'rb') as raw_file:
+                images.append(np.fromfile(raw_file, dtype=np.uint8).reshape(
+                    512, 512, 3
+                ))
+        # MCU aligned tiles are transformed as one image, the others one by
+        # one.
+        for size in ((128, 96), (101, 77)):
+            tiles = [np.ascontiguousarray(img[:size[0], :size[1]])
+                     for img in images]
+            for mode in (1, 2, 4):
+                raw_files = [tempfile.TemporaryFile() for _ in tiles]
+                for raw_file, tile in zip(raw_files, tiles):
+                    tile.tofile(raw_file)
+                    raw_file.seek(0)
+                batch = compress_batch(raw_files, size=size, quality=30,
+                                       subsampling_mode=mode)
+                self.assertEqual(len(batch), len(tiles))
+                # The process pool path passes images and data through
+                # shared memory.
+                for raw_file in raw_files:
+                    raw_file.seek(0)
+                parallel = compress_batch(raw_files, size=size, quality=30,
+                                          subsampling_mode=mode,
+                                          max_workers=2)
+                for compressed, expected in zip(parallel, batch):
+                    self.assertEqual(compressed['data'], expected['data'])
+                    self.assertEqual(compressed['header'], expected['header'])
+                for raw_file, compressed in zip(raw_files, batch):
+                    raw_file.seek(0)
+                    expected = compress(raw_file, size=size, quality=30,
+                                        subsampling_mode=mode)
+                    raw_file.close()
+                    self.assertEqual(compressed['data'], expected['data'])
+                    self.assertEqual(compressed['header'], expected['header'])
+        for max_workers in (1, 2):
+            self.assertEqual(compress_batch([], size=(128, 96),
+                                            max_workers=max_workers), [])
+
+    def test_analyze(self):
+        for fn, grey_level in (('tests/images/rgb/Baboon.raw', False),
+                               ('tests/images/grey_level/Lena.raw', True)):
+            with open(fn, 'rb') as raw_file:
+                analysis = analyze(raw_file, size=(512, 512), quality=30,
+                                   grey_level=grey_level)
+                raw_file.seek(0)
+                compressed = compress(raw_file, size=(512, 512), quality=30,
+                                      grey_level=grey_level)
+            self.assertEqual(analysis['bits'], len(compressed['data']))
+            self.assertEqual(analysis['size'],
+                             len(compressed['data'].tobytes()))
+            self.assertSequenceEqual(
+                analysis['data_slice_lengths'],
+                compressed['header']['data_slice_lengths']
+            )
+            self.assertEqual(
+                sum(sum(layer.values())
+                    for layer in analysis['layers'].values()),
+                analysis['bits']
+            )
+            histograms = (analysis['histograms'] if grey_level
+                          else analysis['histograms'][LUMINANCE])
+            self.assertEqual(histograms[AC][EOB], 64 * 64)
+            self.assertEqual(sum(histograms[DC].values()), 64 * 64)
+            if not grey_level:
+                self.assertEqual(
+                    analysis['histograms'][CHROMINANCE][AC][EOB],
+                    2 * 32 * 32
+                )
+
     def test_grey_level(self):
         compress_and_extract({
             'fn': 'tests/images/grey_level/Baboon.raw',
@@ -169,6 +774,28 @@ class TestCompressAndExtract(unittest.TestCase):
             'subsampling_mode': 4
         })
 
+    def test_flat_blocks(self):
+        with open('tests/images/rgb/Lena.raw', 'rb') as raw_file:
+            lena = np.fromfile(raw_file, dtype=np.uint8).reshape(512, 512, 3)
+        original = np.pad(lena[200:264, 200:264], ((40, 40), (40, 40), (0, 0)),
+                          mode='constant', constant_values=200)
+        with tempfile.NamedTemporaryFile() as raw_file:
+            original.tofile(raw_file)
+            raw_file.flush()
+            extracted = compress_and_extract({
+                'fn': raw_file.name,
+                'size': (144, 144),
+                'grey_level': False,
+                'quality': 80,
+                'subsampling_mode': 4
+            })
+        self.assertGreater(psnr(original.flatten(), extracted), 30)
+        # The flat border survives untouched.
+        np.testing.assert_array_equal(
+            extracted.reshape(144, 144, 3)[:40, :40],
+            original[:40, :40]
+        )
+
 
 def compress_and_extract(spec):
     with open(spec['fn'], 'rb') as raw_file:
@@ -177,7 +804,11 @@ def compress_and_extract(spec):
             size=spec['size'],
             grey_level=spec['grey_level'],
             quality=spec['quality'],
-            subsampling_mode=spec['subsampling_mode']
+            subsampling_mode=spec['subsampling_mode'],
+            fixed_point=spec.get('fixed_point', False),
+            box_filter=spec.get('box_filter', False),
+            compact=spec.get('compact', False),
+            rdo=spec.get('rdo', False)
         )
     header = compressed['header']
     with tempfile.TemporaryFile() as compressed_file:
@@ -192,6 +823,8 @@ def compress_and_extract(spec):
                 'subsampling_mode': header['subsampling_mode'],
                 'remaining_bits_length': header['remaining_bits_length'],
                 'data_slice_lengths': header['data_slice_lengths']
-            }
+            },
+            fixed_point=spec.get('fixed_point', False),
+            compact=spec.get('compact', False)
         )
     return extracted
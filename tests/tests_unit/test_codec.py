@@ -1,13 +1,14 @@
+import collections
 import itertools
 import unittest
 
 import numpy as np
 
 from prototype_jpeg.codec import (
-    Encoder, Decoder, decode_huffman, encode_huffman, encode_differential,
-    decode_differential, iter_zig_zag, inverse_iter_zig_zag, encode_run_length,
-    decode_run_length, EOB, ZRL, DC, AC, LUMINANCE, CHROMINANCE,
-    HUFFMAN_CATEGORY_CODEWORD
+    BlockCache, Encoder, Decoder, count_bits, decode_huffman, encode_huffman,
+    encode_differential, decode_differential, iter_zig_zag,
+    inverse_iter_zig_zag, encode_run_length, decode_run_length, EOB, ZRL, DC,
+    AC, LUMINANCE, CHROMINANCE, HUFFMAN_CATEGORY_CODEWORD
 )
 from prototype_jpeg.utils import Y, CB, CR
 
@@ -157,6 +158,27 @@ class TestEncoder(unittest.TestCase):
                 expect
             )
 
+    def test_run_length_ac_flat_block(self):
+        test_input = np.zeros((3, 8, 8), dtype=int)
+        test_input[:, 0, 0] = (-5, 0, 7)
+        self.assertSequenceEqual(
+            Encoder(test_input, LUMINANCE).run_length_ac,
+            [EOB, EOB, EOB]
+        )
+
+    def test_encode_repeated_blocks(self):
+        block = np.zeros((8, 8), dtype=int)
+        block[0, :3] = (30, -2, 5)
+        block[4, 1] = 1
+        test_input = np.stack((block, block, np.roll(block, 1), block))
+        test_input[:, 0, 0] = (30, 12, -4, 7)
+        encoder = Encoder(test_input, LUMINANCE)
+        expect = ''.join(encode_huffman(v, LUMINANCE)
+                         for v in Encoder(test_input, LUMINANCE).run_length_ac)
+        self.assertEqual(encoder.encode()[AC], expect)
+        self.assertEqual(encoder.ac_cache.hits, 2)
+        self.assertEqual(encoder.ac_cache.misses, 2)
+
     def test_encode_luminance(self):
         test_diff_dc = (63, 2, -7, 3)
         test_run_length_ac = [
@@ -198,6 +220,52 @@ class TestEncoder(unittest.TestCase):
         self.assertDictEqual(encoder.encode(), expect)
 
 
+class TestCountBits(unittest.TestCase):
+    def test_count_bits(self):
+        rng = np.random.default_rng(1105)
+        for layer_type in (LUMINANCE, CHROMINANCE):
+            for scale, density in ((0.5, 0.05), (4, 0.2), (60, 0.6)):
+                data = np.rint(
+                    rng.standard_normal((20, 8, 8)) * scale
+                    * (rng.random((20, 8, 8)) < density)
+                ).astype(int)
+                data[:, 0, 0] = rng.integers(-1000, 1000, 20)
+                data[3, 7, 7] = 1  # After the longest zeros run.
+                encoded = Encoder(data, layer_type).encode()
+                self.assertDictEqual(
+                    count_bits(data, layer_type),
+                    {DC: len(encoded[DC]), AC: len(encoded[AC])}
+                )
+
+    def test_count_bits_without_ac(self):
+        data = np.zeros((3, 8, 8), dtype=int)
+        data[:, 0, 0] = (3, 3, -1)
+        self.assertDictEqual(
+            count_bits(data, LUMINANCE),
+            {DC: (3 + 2) + 2 + (3 + 3), AC: 3 * 4}
+        )
+
+
+class TestBlockCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = BlockCache()
+        self.assertIsNone(cache.get(b'a'))
+        cache.put(b'a', '1010')
+        self.assertEqual(cache.get(b'a'), '1010')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evict_least_recently_used(self):
+        cache = BlockCache(maxsize=2)
+        cache.put(b'a', '0')
+        cache.put(b'b', '1')
+        cache.get(b'a')
+        cache.put(b'c', '10')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), '0')
+        self.assertEqual(cache.get(b'c'), '10')
+
+
 class TestDecoder(unittest.TestCase):
     def test_dc(self):
         test_instances = (
@@ -333,6 +401,17 @@ class TestDecoder(unittest.TestCase):
         ])
         np.testing.assert_array_equal(test_instance.decode(), expect)
 
+    def test_decode_dtype(self):
+        result = Decoder({
+            DC: '11101111 110111'.replace(' ', ''),
+            AC: ''.join((
+                '011', '1111111010', '1111111010', '110100', '00',
+                '00'
+            ))
+        }, CHROMINANCE, dtype=np.int16).decode()
+        self.assertEqual(result.dtype, np.int16)
+        self.assertSequenceEqual(result[:, 0, 0].tolist(), (15, 22))
+
     def test_decode_chrominance_cannot_divided_evenly_by_2(self):
         test_input_dc = {
             DC: '11101111 110111 11101111'.replace(' ', ''),
@@ -0,0 +1,87 @@
+import collections
+import unittest
+
+import numpy as np
+
+from prototype_jpeg.codec import (Encoder, Decoder, count_bits, EOB, ZRL, DC,
+                                  AC, LUMINANCE)
+from prototype_jpeg.optimize import (symbol_histogram, optimize_quantization,
+                                     optimize_huffman_table, huffman_codeword)
+
+
+class TestSymbolHistogram(unittest.TestCase):
+    def test_symbol_histogram(self):
+        data = np.zeros((3, 8, 8), dtype=int)
+        data[:, 0, 0] = (14, 44, 6)
+        data[0, 0, 1:4] = (1, 0, -1)
+        data[1, 7, 7] = 99
+        data[2, 1, 0] = 3
+        self.assertDictEqual(symbol_histogram(data), {
+            DC: collections.Counter({4: 1, 5: 1, 6: 1}),
+            AC: collections.Counter({
+                (0, 1): 1, (4, 1): 1, (14, 7): 1, (1, 2): 1, ZRL: 3, EOB: 3
+            })
+        })
+
+
+class TestOptimizeQuantization(unittest.TestCase):
+    def setUp(self):
+        self.data = np.zeros((2, 8, 8))
+        self.data[:, 0, 0] = (-3.4, 5.6)
+        self.data[0, 0, 1] = 9.8
+        self.data[0, 7, 7] = 0.6
+        self.data[1, 1, 0] = 4.2
+
+    def test_uniform_rounding(self):
+        np.testing.assert_array_equal(
+            optimize_quantization(self.data, LUMINANCE, lagrangian=0),
+            np.rint(self.data)
+        )
+
+    def test_zero_and_lower(self):
+        expect = np.rint(self.data)
+        # Trailing AC far from the others costs a ZRL chain.
+        expect[0, 7, 7] = 0
+        # Lowering 4 to 3 reduces its size (category) by 1.
+        expect[1, 1, 0] = 3
+        optimized = optimize_quantization(self.data, LUMINANCE, lagrangian=1)
+        np.testing.assert_array_equal(optimized, expect)
+        self.assertLess(count_bits(optimized, LUMINANCE)[AC],
+                        count_bits(np.rint(self.data), LUMINANCE)[AC])
+
+
+class TestOptimizeHuffmanTable(unittest.TestCase):
+    def test_optimize_huffman_table(self):
+        histogram = collections.Counter({(0, i): 2 ** i for i in range(1, 30)})
+        histogram[EOB] = 1
+        counts, symbols = optimize_huffman_table(histogram)
+        self.assertEqual(len(counts), 16)
+        self.assertEqual(sum(counts), len(histogram))
+        self.assertCountEqual(symbols, histogram)
+        codeword = huffman_codeword(counts, symbols)
+        self.assertLessEqual(max(len(code) for code in codeword.values()), 16)
+        for code in codeword.values():
+            self.assertNotEqual(set(code), {'1'})
+            self.assertFalse(any(other != code and other.startswith(code)
+                                 for other in codeword.values()))
+        # More frequent symbols have shorter codewords.
+        self.assertLessEqual(len(codeword[(0, 29)]), len(codeword[(0, 1)]))
+
+    def test_encode_and_decode(self):
+        data = np.zeros((3, 8, 8), dtype=int)
+        data[:, 0, 0] = (14, 44, 6)
+        data[0, 0, 1:4] = (1, 0, -1)
+        data[1, 7, 7] = 99
+        histograms = symbol_histogram(data)
+        codeword = {dc_ac: huffman_codeword(
+            *optimize_huffman_table(histograms[dc_ac])
+        ) for dc_ac in (DC, AC)}
+        encoded = Encoder(data, LUMINANCE, codeword=codeword).encode()
+        np.testing.assert_array_equal(
+            Decoder(encoded, LUMINANCE, codeword=codeword).decode(),
+            data
+        )
+        self.assertLess(
+            sum(map(len, encoded.values())),
+            sum(map(len, Encoder(data, LUMINANCE).encode().values()))
+        )
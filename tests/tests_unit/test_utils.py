@@ -3,9 +3,39 @@ import unittest
 
 import numpy as np
 
-from prototype_jpeg.utils import (rgb2ycbcr, ycbcr2rgb, downsample, upsample,
-                                  block_slice, block_combine, dct2d, idct2d,
-                                  quantize, Y, CB, CR, R, G, B)
+from prototype_jpeg.utils import (rgb2ycbcr, ycbcr2rgb, rgb2ycbcr_fixed,
+                                  ycbcr2rgb_fixed, rgb2ycbcr_downsample,
+                                  ycbcr2rgb_upsample, downsample, upsample,
+                                  block_slice, block_combine, block_view,
+                                  pad_block_slice, crop_block_combine,
+                                  flat_blocks, dct2d, idct2d, quantize, psnr,
+                                  estimate_psnr, reorient_blocks, is_grey,
+                                  downscale_blocks,
+                                  scaled_quantization_table, Y, CB, CR, R, G,
+                                  B)
+
+
+class TestPSNR(unittest.TestCase):
+    def test_psnr_uint8(self):
+        self.assertAlmostEqual(
+            psnr(np.array([0, 10], dtype=np.uint8),
+                 np.array([1, 9], dtype=np.uint8)),
+            20 * np.log10(255)
+        )
+
+    def test_estimate_psnr(self):
+        rng = np.random.default_rng(1105)
+        pixels = rng.uniform(-128, 127, (10, 8, 8))
+        coefficients = {Y: np.array([dct2d(block) for block in pixels])}
+        quantized = {Y: np.rint(quantize(coefficients[Y], Y, quality=30))}
+        extracted = np.array([
+            idct2d(block)
+            for block in quantize(quantized[Y], Y, quality=30, inverse=True)
+        ])
+        self.assertAlmostEqual(
+            estimate_psnr(coefficients, quantized, 30),
+            psnr(pixels, extracted)
+        )
 
 
 class TestColorSpaceConversion(unittest.TestCase):
@@ -58,6 +88,82 @@ class TestColorSpaceConversion(unittest.TestCase):
         for r, e in zip(test_input.values(), result.values()):
             np.testing.assert_array_almost_equal(r, e, decimal=0)
 
+    def test_rgb2ycbcr_fixed(self):
+        test_input = np.arange(256 * 3, dtype=np.uint8).reshape(16, 16, 3)
+        expect = rgb2ycbcr(*(test_input[:, :, i] for i in range(3)))
+        result = rgb2ycbcr_fixed(test_input)
+        for r, e in zip(result.values(), expect.values()):
+            np.testing.assert_array_almost_equal(r, e, decimal=0)
+
+    def test_ycbcr2rgb_fixed(self):
+        test_input = np.linspace(0, 255, 3 * 8 * 8, dtype=np.uint8).reshape(
+            8, 8, 3
+        )
+        expect = ycbcr2rgb(
+            test_input[:, :, 0],
+            test_input[:, :, 1] - 128.0,
+            test_input[:, :, 2] - 128.0
+        )
+        result = ycbcr2rgb_fixed(*(test_input[:, :, i] for i in range(3)))
+        self.assertEqual(result.dtype, np.uint8)
+        for i, e in enumerate(expect.values()):
+            np.testing.assert_array_almost_equal(
+                result[:, :, i], np.clip(e, 0, 255), decimal=0
+            )
+        # Neutral chroma leaves grey levels unchanged.
+        grey = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        neutral = np.full_like(grey, 128)
+        result = ycbcr2rgb_fixed(grey, neutral, neutral)
+        for i in range(3):
+            np.testing.assert_array_equal(result[:, :, i], grey)
+
+    def test_rgb2ycbcr_downsample(self):
+        test_input = np.arange(5 * 7 * 3, dtype=np.uint8).reshape(5, 7, 3)
+        for mode in (1, 2, 4):
+            expect = rgb2ycbcr(*(test_input[:, :, i] for i in range(3)))
+            expect[CB] = downsample(expect[CB], mode)
+            expect[CR] = downsample(expect[CR], mode)
+            result = rgb2ycbcr_downsample(test_input, mode)
+            for r, e in zip(result.values(), expect.values()):
+                np.testing.assert_array_equal(r, e)
+
+    def test_rgb2ycbcr_downsample_box_filter(self):
+        test_input = np.arange(4 * 4 * 3, dtype=np.uint8).reshape(4, 4, 3)
+        expect = rgb2ycbcr(*(test_input[:, :, i] for i in range(3)))
+        result = rgb2ycbcr_downsample(test_input, 1, box_filter=True)
+        for key in (CB, CR):
+            np.testing.assert_array_almost_equal(
+                result[key],
+                expect[key].reshape(2, 2, 2, 2).mean(axis=(1, 3))
+            )
+
+    def test_ycbcr2rgb_upsample(self):
+        y = np.linspace(0, 255, 5 * 7).reshape(5, 7)
+        for mode in (1, 2, 4):
+            cb = downsample(np.linspace(-128, 127, 5 * 7).reshape(5, 7), mode)
+            cr = downsample(np.linspace(127, -128, 5 * 7).reshape(5, 7), mode)
+            expect = ycbcr2rgb(
+                y,
+                upsample(cb, mode)[:5, :7],
+                upsample(cr, mode)[:5, :7]
+            )
+            result = ycbcr2rgb_upsample(y, cb, cr, mode)
+            self.assertEqual(result.dtype, np.uint8)
+            for i, e in enumerate(expect.values()):
+                np.testing.assert_array_equal(
+                    result[:, :, i], np.rint(np.clip(e, 0, 255))
+                )
+
+
+class TestIsGrey(unittest.TestCase):
+    def test_is_grey(self):
+        rgb = np.repeat(np.arange(12, dtype=np.uint8), 3).reshape(2, 6, 3)
+        self.assertTrue(is_grey(rgb))
+        rgb[1, 2, 0] += 2
+        self.assertFalse(is_grey(rgb))
+        self.assertFalse(is_grey(rgb, tolerance=1))
+        self.assertTrue(is_grey(rgb, tolerance=2))
+
 
 class TestSampling(unittest.TestCase):
     def test_downsample(self):
@@ -93,6 +199,33 @@ class TestSampling(unittest.TestCase):
             result = downsample(case['input'], case['mode'])
             np.testing.assert_array_equal(result, case['expect'])
 
+    def test_downsample_box_filter(self):
+        cases = ({
+            'input': np.arange(16).reshape(4, 4),
+            'mode': 1,
+            'expect': np.array([
+                [2.5, 4.5],
+                [10.5, 12.5]
+            ])
+        }, {
+            'input': np.arange(6, dtype=float).reshape(2, 3),
+            'mode': 2,
+            'expect': np.array([
+                [0.5, 2],
+                [3.5, 5]
+            ])
+        }, {
+            'input': np.arange(9, dtype=float).reshape(3, 3),
+            'mode': 1,
+            'expect': np.array([
+                [2, 3.5],
+                [6.5, 8]
+            ])
+        })
+        for case in cases:
+            result = downsample(case['input'], case['mode'], box_filter=True)
+            np.testing.assert_array_equal(result, case['expect'])
+
     def test_upsample(self):
         cases = ({
             'input': np.linspace(0, 255, 4, dtype=int).reshape(2, 2),
@@ -192,6 +325,67 @@ class TestBlockSlicingAndCombination(unittest.TestCase):
             block_combine(block_slice(test_input, 2, 2), 8, 8)
         )
 
+    def test_block_view(self):
+        test_input = np.arange(30).reshape(5, 6)
+        view = block_view(test_input, 2, 3)
+        self.assertEqual(view.shape, (2, 2, 2, 3))
+        np.testing.assert_array_equal(
+            view.reshape(-1, 2, 3),
+            block_slice(test_input[:4], 2, 3)
+        )
+        view[1, 0] = -1
+        np.testing.assert_array_equal(test_input[2:4, :3], -1)
+
+    def test_pad_block_slice(self):
+        for shape in ((8, 8), (5, 7), (9, 4), (3, 3)):
+            test_input = np.arange(np.prod(shape)).reshape(shape) + 1
+            padded = np.pad(
+                test_input,
+                ((0, -shape[0] % 4), (0, -shape[1] % 4)),
+                mode='constant'
+            )
+            result = pad_block_slice(test_input, 4, 4)
+            self.assertEqual(result.dtype, float)
+            np.testing.assert_array_equal(result, block_slice(padded, 4, 4))
+
+    def test_crop_block_combine(self):
+        for shape in ((8, 8), (5, 7), (9, 4), (3, 3)):
+            test_input = np.arange(np.prod(shape)).reshape(shape)
+            np.testing.assert_array_equal(
+                crop_block_combine(pad_block_slice(test_input, 4, 4, int),
+                                   *shape),
+                test_input
+            )
+
+    def test_crop_block_combine_inequal_number_of_blocks(self):
+        with self.assertRaises(ValueError):
+            crop_block_combine(np.zeros((4, 2, 2)), 5, 5)
+
+
+class TestFlatBlocks(unittest.TestCase):
+    def test_flat_blocks(self):
+        test_input = np.array([
+            [[3, 3],
+             [3, 3]],
+            [[3, 3],
+             [3, 4]],
+            [[-1.5, -1.5],
+             [-1.5, -1.5]]
+        ])
+        np.testing.assert_array_equal(
+            flat_blocks(test_input),
+            (True, False, True)
+        )
+
+    def test_flat_block_dct(self):
+        """The DCT of a flat block only has DC which is 8 * value."""
+        expect = np.zeros((8, 8))
+        expect[0, 0] = 8 * -37.25
+        np.testing.assert_array_almost_equal(
+            dct2d(np.full((8, 8), -37.25)),
+            expect
+        )
+
 
 class TestDCT2D(unittest.TestCase):
     def test_dct2d(self):
@@ -250,7 +444,48 @@ class TestDCT2D(unittest.TestCase):
         np.testing.assert_almost_equal(test_input, idct2d(dct2d(test_input)))
 
 
+class TestReorientBlocks(unittest.TestCase):
+    def test_reorient_blocks(self):
+        image = np.random.RandomState(0).randint(256, size=(16, 24))
+        blocks = np.array([dct2d(block) for block in block_slice(image, 8, 8)])
+        expects = {
+            'flip_horizontal': image[:, ::-1],
+            'flip_vertical': image[::-1],
+            'transpose': image.T,
+            'transverse': image.T[::-1, ::-1],
+            'rotate_90': np.rot90(image, -1),
+            'rotate_180': np.rot90(image, 2),
+            'rotate_270': np.rot90(image, 1)
+        }
+        for operation, expect in expects.items():
+            reoriented = reorient_blocks(blocks, 16, 24, operation)
+            np.testing.assert_array_almost_equal(
+                block_combine(np.array([idct2d(block)
+                                        for block in reoriented]),
+                              *expect.shape),
+                expect
+            )
+
+
+class TestDownscaleBlocks(unittest.TestCase):
+    def test_downscale_blocks(self):
+        image = np.random.RandomState(0).randint(256, size=(32, 48))
+        blocks = np.array([dct2d(block) for block in block_slice(image, 8, 8)])
+        np.testing.assert_array_almost_equal(
+            block_combine(np.array([idct2d(block) for block
+                                    in downscale_blocks(blocks, 4, 6)]),
+                          16, 24),
+            image.reshape(16, 2, 24, 2).mean(axis=(1, 3))
+        )
+
+
 class TestQuantization(unittest.TestCase):
+    def test_transposed_table(self):
+        np.testing.assert_array_equal(
+            scaled_quantization_table(CB, 30, transposed=True),
+            scaled_quantization_table(CB, 30).T
+        )
+
     def test_quantize(self):
         test_input = np.array([
             [236, -1, -12, -5, 2, -2, -3, 1],
@@ -283,6 +518,15 @@ class TestQuantization(unittest.TestCase):
             decimal=0
         )
 
+    def test_quantize_float32(self):
+        test_input = np.arange(64, dtype=np.float32).reshape(8, 8)
+        self.assertEqual(quantize(test_input, Y).dtype, np.float32)
+        self.assertEqual(
+            quantize(test_input.astype(np.int16), CB, inverse=True).dtype,
+            np.float32
+        )
+        self.assertEqual(quantize(test_input.astype(int), Y).dtype, float)
+
     def test_inverse_quantize(self):
         test_input = np.array([
             [15, 0, -1, 0, 0, 0, 0, 0],